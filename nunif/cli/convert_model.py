@@ -0,0 +1,50 @@
+# Convert model files between .pth and .safetensors
+# python -m nunif.cli.convert_model -i ./waifu2x/pretrained_models -o ./waifu2x/pretrained_models
+import os
+from os import path
+import argparse
+from .. models.utils import convert_model_file, SAFETENSORS_EXT
+from .. logger import logger
+from .. addon import load_addons
+
+
+def list_model_files(input_dir, ext):
+    files = []
+    for root, _, filenames in os.walk(input_dir):
+        for filename in sorted(filenames):
+            if path.splitext(filename)[-1].lower() == ext:
+                files.append(path.join(root, filename))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--input", "-i", type=str, required=True, help="input model file or directory")
+    parser.add_argument("--output", "-o", type=str, required=True,
+                        help="output model file or directory. it can be the same as the input directory")
+    parser.add_argument("--format", type=str, choices=["safetensors", "pth"], default="safetensors",
+                        help="output format, used for directory input")
+    parser.add_argument("--addon", type=str, nargs="+", help="dependent addons")
+    args = parser.parse_args()
+    logger.debug(str(args))
+
+    load_addons(args.addon)
+
+    if path.isdir(args.input):
+        input_ext, output_ext = (".pth", SAFETENSORS_EXT) if args.format == "safetensors" else (SAFETENSORS_EXT, ".pth")
+        for input_path in list_model_files(args.input, input_ext):
+            output_path = path.join(args.output, path.relpath(input_path, args.input))
+            output_path = path.splitext(output_path)[0] + output_ext
+            os.makedirs(path.dirname(output_path), exist_ok=True)
+            convert_model_file(input_path, output_path)
+            logger.info(f"{input_path} -> {output_path}")
+    else:
+        output_dir = path.dirname(args.output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        convert_model_file(args.input, args.output)
+        logger.info(f"{args.input} -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ import argparse
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 from .. utils import tiled_render, simple_render, ImageLoader
+from .. utils.render import tiled_render_multi
+from .. utils.autotune import autotune, DEFAULT_CACHE_FILE as DEFAULT_AUTOTUNE_CACHE_FILE
 from .. models import load_model, get_model_config, I2IBaseModel
 from .. logger import logger
 from .. addon import load_addons
@@ -31,14 +33,19 @@ def convert_with_tiled_render(model, args):
     in_size = get_model_config(model, "i2i_in_size")
     in_grayscale = get_model_config(model, "i2i_in_channels") == 1
     tile_size = in_size if in_size is not None else args.tile_size
+    batch_size = args.batch_size
+    if args.autotune and in_size is None:
+        tile_size, batch_size = autotune(model, model_file=args.model_file, cache_file=args.autotune_cache)
 
     if is_dir:
         os.makedirs(args.output, exist_ok=True)
+        if args.image_batch > 1 and in_size is None:
+            return convert_with_tiled_render_multi(model, loader, tile_size, batch_size, args)
     with torch.no_grad(), PoolExecutor() as pool:
         for im, meta in tqdm(loader, ncols=60):
             if in_grayscale:
                 im = TF.to_grayscale(im)
-            z = tiled_render(TF.to_tensor(im), model, tile_size=tile_size, batch_size=args.batch_size).to("cpu")
+            z = tiled_render(TF.to_tensor(im), model, tile_size=tile_size, batch_size=batch_size).to("cpu")
             if is_dir:
                 output_filename = path.splitext(path.basename(meta["filename"]))[0] + ".png"
                 pool.submit(save_image, TF.to_pil_image(z), path.join(args.output, output_filename))
@@ -46,6 +53,30 @@ def convert_with_tiled_render(model, args):
                 pool.submit(save_image, TF.to_pil_image(z), args.output)
 
 
+def convert_with_tiled_render_multi(model, loader, tile_size, batch_size, args):
+    # packs the tiles of `--image-batch` images into shared minibatches. effective for many small images
+    in_grayscale = get_model_config(model, "i2i_in_channels") == 1
+
+    def flush(xs, output_paths, pool):
+        zs = tiled_render_multi(xs, model, tile_size=tile_size, batch_size=batch_size)
+        for z, output_path in zip(zs, output_paths):
+            pool.submit(save_image, TF.to_pil_image(z.to("cpu")), output_path)
+
+    with torch.no_grad(), PoolExecutor() as pool:
+        xs, output_paths = [], []
+        for im, meta in tqdm(loader, ncols=60):
+            if in_grayscale:
+                im = TF.to_grayscale(im)
+            xs.append(TF.to_tensor(im))
+            output_filename = path.splitext(path.basename(meta["filename"]))[0] + ".png"
+            output_paths.append(path.join(args.output, output_filename))
+            if len(xs) == args.image_batch:
+                flush(xs, output_paths, pool)
+                xs, output_paths = [], []
+        if xs:
+            flush(xs, output_paths, pool)
+
+
 def convert_with_simple_render_single(model, args):
     loader, is_dir = make_loader(args.input)
     in_grayscale = get_model_config(model, "i2i_in_channels") == 1
@@ -56,7 +87,9 @@ def convert_with_simple_render_single(model, args):
         for im, meta in tqdm(loader, ncols=60):
             if in_grayscale:
                 im = TF.to_grayscale(im)
-            z = simple_render(TF.to_tensor(im), model).to('cpu')
+            # falls back to tiled render for large images
+            z = simple_render(TF.to_tensor(im), model,
+                              tile_size=args.tile_size, batch_size=args.batch_size).to('cpu')
             if is_dir:
                 output_filename = path.splitext(path.basename(meta["filename"]))[0] + ".png"
                 pool.submit(save_image, TF.to_pil_image(z), path.join(args.output, output_filename))
@@ -108,8 +141,16 @@ def main():
     parser.add_argument("--model-file", type=str, required=True, help="model file")
     parser.add_argument("--gpu", "-g", type=int, nargs="+", default=[0], help="gpu ids. -1 for CPU")
     parser.add_argument("--batch-size", type=int, default=4, help="minibatch_size")
-    parser.add_argument("--tiled-render", "-t", action='store_true', help="use tiled render")
+    parser.add_argument("--tiled-render", "-t", action='store_true',
+                        help="always use tiled render. otherwise it is used only when the whole image does not fit in memory")
     parser.add_argument("--tile-size", type=int, default=256, help="tile size for tiled render")
+    parser.add_argument("--image-batch", type=int, default=1,
+                        help=("number of images whose tiles are packed into shared minibatches in tiled render. "
+                              "effective for many small images"))
+    parser.add_argument("--autotune", action="store_true",
+                        help="benchmark and use the best --tile-size and --batch-size for tiled render")
+    parser.add_argument("--autotune-cache", type=str, default=DEFAULT_AUTOTUNE_CACHE_FILE,
+                        help="cache file for --autotune results")
     parser.add_argument("--tta", action='store_true', help="use TTA")
     parser.add_argument("--output", "-o", type=str, required=True, help="output file/directory")
     parser.add_argument("--input", "-i", type=str, required=True, help="input file/directory")
@@ -3,10 +3,11 @@ from . utils import (
     load_model, save_model,
     get_model_config, get_model_kwargs, get_model_device, call_model_method)
 from . register import register_model, create_model, register_models, get_model_names
+from . quantize import QuantizedI2IModel
 
 
 __all__ = [
-    "Model", "I2IBaseModel",
+    "Model", "I2IBaseModel", "QuantizedI2IModel",
     "load_model", "save_model",
     "get_model_config", "get_model_kwargs", "get_model_device", "call_model_method",
     "register_model", "register_models", "create_model", "get_model_names"
@@ -0,0 +1,253 @@
+# Optimized inference modules (TorchScript, torch.compile, fused channels_last) for loaded models
+import os
+from os import path
+import hashlib
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from . utils import get_model_config, get_model_device
+from .. logger import logger
+
+
+OPTIMIZE_METHODS = ("none", "script", "compile", "fuse")
+DEFAULT_CACHE_DIR = path.join(path.expanduser("~"), ".cache", "nunif", "optimize")
+
+
+class OptimizedModel(nn.Module):
+    """
+    Wrapper of the original model and its optimized module.
+    `forward()` runs the optimized module. The model config, kwargs and device are taken from the original model,
+    so it can be used with `tiled_render()` as is.
+    The original model is kept for the model replicas (see `unwrap_optimized_model()`),
+    so the weights are held twice. See `script_constant_bytes()` for the frozen TorchScript module.
+    """
+    def __init__(self, model, module, method):
+        super().__init__()
+        self.model = model
+        self.module = module
+        self.method = method
+        self.name = model.name
+
+    def forward(self, x):
+        return self.module(x)
+
+    def get_config(self):
+        return self.model.get_config()
+
+    def get_kwargs(self):
+        return self.model.get_kwargs()
+
+    def get_device(self):
+        return self.model.get_device()
+
+
+def unwrap_optimized_model(model):
+    """ returns the original eager model. Optimized modules cannot be copied or sent to other processes
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if isinstance(model, OptimizedModel):
+        return model.model
+    return model
+
+
+def script_constant_bytes(model):
+    """ returns the size of the tensor constants of the frozen TorchScript module in `OptimizedModel`.
+    Frozen modules have the weights inlined as constants instead of parameters, so they are a second copy of
+    the weights that `parameters()` does not count.
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if not (isinstance(model, OptimizedModel) and isinstance(model.module, torch.jit.ScriptModule)):
+        return 0
+    seen = set()
+    size = 0
+    for node in model.module.graph.nodes():
+        if node.kind() == "prim::Constant" and node.output().type().kind() == "TensorType":
+            t = node.output().toIValue()
+            if t.data_ptr() not in seen:
+                seen.add(t.data_ptr())
+                size += t.numel() * t.element_size()
+    return size
+
+
+def _has_conv_pointwise():
+    return torch.backends.mkldnn.is_available() and hasattr(torch.ops.mkldnn, "_convolution_pointwise")
+
+
+class ConvLeakyReLU(nn.Module):
+    """
+    Conv2d followed by LeakyReLU.
+    On CPU, it runs as one oneDNN convolution with the activation as the post-op,
+    so the output is not read and written again by the activation.
+    """
+    def __init__(self, conv, negative_slope):
+        super().__init__()
+        self.conv = conv
+        self.negative_slope = negative_slope
+        self.fused = _has_conv_pointwise()
+
+    def forward(self, x):
+        if self.fused and x.device.type == "cpu" and x.dtype == torch.float32 and not torch.is_grad_enabled():
+            conv = self.conv
+            return torch.ops.mkldnn._convolution_pointwise(
+                x, conv.weight, conv.bias,
+                list(conv.padding), list(conv.stride), list(conv.dilation), conv.groups,
+                "leaky_relu", [self.negative_slope], "")
+        return F.leaky_relu(self.conv(x), self.negative_slope, inplace=True)
+
+
+def _leaky_relu_slope(node, modules):
+    # returns negative_slope when the node is LeakyReLU, otherwise None
+    if node.op == "call_module" and isinstance(modules.get(node.target), nn.LeakyReLU):
+        return modules[node.target].negative_slope
+    if node.op == "call_function" and node.target is F.leaky_relu:
+        if len(node.args) > 1:
+            return node.args[1]
+        return node.kwargs.get("negative_slope", 0.01)
+    return None
+
+
+def fuse_conv_leaky_relu(model):
+    """
+    Replace Conv2d + LeakyReLU pairs with `ConvLeakyReLU` using torch.fx.
+    Both LeakyReLU modules and `F.leaky_relu` calls are matched.
+    Returns `torch.fx.GraphModule`. Raises an error when the model cannot be traced.
+    """
+    gm = torch.fx.symbolic_trace(model)
+    modules = dict(gm.named_modules())
+    conv_calls = {}
+    for node in gm.graph.nodes:
+        if node.op == "call_module":
+            conv_calls[node.target] = conv_calls.get(node.target, 0) + 1
+    num_fused = 0
+    for node in list(gm.graph.nodes):
+        conv = modules.get(node.target) if node.op == "call_module" else None
+        if not (isinstance(conv, nn.Conv2d) and conv.padding_mode == "zeros" and not isinstance(conv.padding, str)):
+            continue
+        # shared conv modules can not be replaced
+        if conv_calls[node.target] != 1 or len(node.users) != 1:
+            continue
+        act = next(iter(node.users))
+        negative_slope = _leaky_relu_slope(act, modules)
+        if negative_slope is None:
+            continue
+        parent_name, _, name = node.target.rpartition(".")
+        setattr(gm.get_submodule(parent_name), name, ConvLeakyReLU(conv, negative_slope))
+        act.replace_all_uses_with(node)
+        gm.graph.erase_node(act)
+        num_fused += 1
+    gm.graph.lint()
+    gm.recompile()
+    logger.debug(f"optimize: fused {num_fused} Conv2d+LeakyReLU")
+    return gm
+
+
+class ChannelsLast(nn.Module):
+    """ Run the module in channels_last memory format
+    """
+    def __init__(self, module):
+        super().__init__()
+        self.module = module.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.module(x.contiguous(memory_format=torch.channels_last))
+
+
+def _fuse(model):
+    # raises an error when the model can not be traced, e.g. data dependent control flow.
+    # channels_last alone does not help such models (swin_unet is BHWC internally)
+    return ChannelsLast(fuse_conv_leaky_relu(model.to_inference_model()))
+
+
+def _cache_file(model_file, device):
+    mtime = int(path.getmtime(model_file))
+    key = f"{path.abspath(model_file)}:{mtime}:{torch.device(device).type}:{torch.__version__}"
+    return path.join(DEFAULT_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+
+def _script(model, model_file=None, use_cache=True):
+    device = get_model_device(model)
+    cache_file = None
+    if use_cache and model_file is not None and path.exists(model_file):
+        cache_file = _cache_file(model_file, device)
+        if path.exists(cache_file):
+            logger.debug(f"optimize: load cache: {cache_file}")
+            return torch.jit.load(cache_file, map_location=device)
+    module = torch.jit.freeze(model.to_script_module())
+    if cache_file is not None:
+        os.makedirs(path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + f".{os.getpid()}.tmp"
+        torch.jit.save(module, tmp_file)
+        os.replace(tmp_file, cache_file)
+    return module
+
+
+def _compile(model):
+    try:
+        # inductor caches the compiled kernels and graphs on disk by itself
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+    return torch.compile(model.to_inference_model())
+
+
+def _benchmark(module, x, enable_amp, repeat=2):
+    with torch.autocast(device_type=x.device.type, enabled=enable_amp):
+        t = time.perf_counter()
+        for _ in range(repeat):
+            z = module(x)
+        if x.device.type == "cuda":
+            torch.cuda.synchronize(x.device)
+    return (time.perf_counter() - t) / repeat, z
+
+
+def optimize_model(model, method, model_file=None, tile_size=256, batch_size=4, enable_amp=False,
+                   use_cache=True, tolerance=1e-3):
+    """
+    Returns `OptimizedModel` of `model` with `method`,
+    warmed up with the minibatch of (batch_size, tile_size). The warmup output is checked against the eager model.
+    When the optimization fails, the original model is returned.
+    method: script: frozen TorchScript module.
+            compile: torch.compile.
+            fuse: channels_last eager module with fused Conv2d+LeakyReLU.
+    model_file: used as the cache key of TorchScript modules.
+    """
+    assert method in OPTIMIZE_METHODS
+    if method == "none":
+        return model
+    model = unwrap_optimized_model(model)
+    device = get_model_device(model)
+    in_channels = get_model_config(model, "i2i_in_channels") or 3
+    x = torch.rand((batch_size, in_channels, tile_size, tile_size), device=device)
+    try:
+        with torch.no_grad():
+            if method == "script":
+                module = _script(model, model_file=model_file, use_cache=use_cache)
+            elif method == "compile":
+                module = _compile(model)
+            else:
+                module = _fuse(model)
+            t = time.perf_counter()
+            _benchmark(module, x, enable_amp, repeat=1)
+            warmup_time = time.perf_counter() - t
+            # second call for the tracing JIT of TorchScript
+            _benchmark(module, x, enable_amp, repeat=1)
+            optimized_time, z = _benchmark(module, x, enable_amp)
+            eager_time, z_eager = _benchmark(model, x, enable_amp)
+    except Exception as e:
+        logger.warning(f"optimize: {method} failed for {model.name}, use the eager model: {repr(e)}")
+        return model
+
+    diff = (z.float() - z_eager.float()).abs().max().item()
+    if diff > tolerance:
+        logger.warning(f"optimize: {method} output of {model.name} differs from the eager model "
+                       f"(max diff={diff}), use the eager model")
+        return model
+    logger.info(f"optimize: {method}: {model.name}: warmup {round(warmup_time, 2)}s, "
+                f"{round(eager_time / optimized_time, 2)}x speedup on {device.type} "
+                f"(tile_size={tile_size}, batch_size={batch_size})")
+
+    return OptimizedModel(model, module, method)
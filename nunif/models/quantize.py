@@ -0,0 +1,159 @@
+# Post-training int8 quantization for CPU inference
+import warnings
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from . model import I2IBaseModel
+from . register import register_model, create_model
+from . utils import get_model_config
+from .. logger import logger
+
+
+QUANTIZE_MODES = ("static", "dynamic")
+# in order of preference. qnnpack is for ARM
+QUANTIZED_ENGINES = ("x86", "fbgemm", "qnnpack")
+
+
+def _import_quantization():
+    # torch.ao.quantization is deprecated in favor of torchao, but it is the only one in torch itself
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        from torch.ao import quantization
+        from torch.ao.quantization import quantize_fx
+    return quantization, quantize_fx
+
+
+def select_quantized_engine(engine=None):
+    """ returns the quantized engine to use. When `engine` is None, the first supported one of `QUANTIZED_ENGINES`.
+    `torch.backends.quantized.engine` is set only when it is different, because the int8 weights are packed
+    for the current engine when they are created or loaded.
+    """
+    supported_engines = torch.backends.quantized.supported_engines
+    if engine is None:
+        engine = next((name for name in QUANTIZED_ENGINES if name in supported_engines), None)
+        if engine is None:
+            raise RuntimeError(f"no quantized engine is available. supported_engines={supported_engines}")
+    elif engine not in supported_engines:
+        raise ValueError(f"the int8 model is quantized for the `{engine}` engine, "
+                         f"but it is not supported on this machine. supported_engines={supported_engines}")
+    if torch.backends.quantized.engine != engine:
+        logger.debug(f"quantized engine: {torch.backends.quantized.engine} -> {engine}")
+        torch.backends.quantized.engine = engine
+    return engine
+
+
+def _trace_for_static(model):
+    # returns GraphModule without in-place activations (quantized ops do not support them)
+    # and the name of the last conv layer, that is kept in float for the output precision
+    gm = torch.fx.symbolic_trace(model.to_inference_model())
+    modules = dict(gm.named_modules())
+    last_conv = None
+    for node in gm.graph.nodes:
+        if node.op == "call_module":
+            module = modules[node.target]
+            if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)):
+                last_conv = node.target
+            elif hasattr(module, "inplace"):
+                module.inplace = False
+        elif node.op == "call_function" and node.target in {F.leaky_relu, F.relu} and node.kwargs.get("inplace"):
+            node.kwargs = {**node.kwargs, "inplace": False}
+    gm.recompile()
+    return gm, last_conv
+
+
+def _quantize_static(model, calibration_data, engine):
+    quantization, quantize_fx = _import_quantization()
+    gm, last_conv = _trace_for_static(model)
+    qconfig_mapping = quantization.get_default_qconfig_mapping(engine)
+    if last_conv is not None:
+        qconfig_mapping.set_module_name(last_conv, None)
+    in_channels = get_model_config(model, "i2i_in_channels") or 3
+    example_inputs = (torch.zeros((1, in_channels, 64, 64)),)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        prepared = quantize_fx.prepare_fx(gm, qconfig_mapping, example_inputs)
+        if calibration_data is not None:
+            for x in calibration_data:
+                prepared(x)
+        return quantize_fx.convert_fx(prepared)
+
+
+def _dynamic_quantize_targets(model):
+    # Linear layers whose weight is read directly by the parent, e.g. torchvision's ShiftedWindowAttention
+    # (F.linear(x, self.qkv.weight, ...)), can not be replaced with the dynamic quantized Linear
+    # whose `weight` is a method
+    excluded = set()
+    for name, module in model.named_modules():
+        if type(module).__name__.startswith("ShiftedWindowAttention"):
+            excluded.update(f"{name}.{child}" for child, _ in module.named_modules() if child)
+    return {name for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and name not in excluded}
+
+
+def _quantize_dynamic(model):
+    quantization, _ = _import_quantization()
+    model = model.to_inference_model()
+    targets = _dynamic_quantize_targets(model)
+    if not targets:
+        raise ValueError(f"{model.name}: no layers for dynamic quantization")
+    qconfig_spec = {name: quantization.default_dynamic_qconfig for name in targets}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+@register_model
+class QuantizedI2IModel(I2IBaseModel):
+    """
+    int8 quantized version of I2I model `base_name(**base_kwargs)`. CPU only.
+    mode: static: Conv and Linear layers with the activation scales calibrated on sample images.
+                  The model must be traceable with torch.fx. The last conv layer is kept in float.
+          dynamic: Linear layers with the activation scales computed at runtime.
+    engine: quantized engine (see `QUANTIZED_ENGINES`). None selects the first supported one.
+            The engine is saved with the model, and loading fails with ValueError when it is not supported.
+    The quantized structure is created in `__init__()`, so the model can be loaded with `load_model()`.
+    Use `quantize_model()` to create the calibrated model from the float model.
+    """
+    name = "nunif.quantized_i2i"
+
+    def __init__(self, base_name, base_kwargs, mode="static", engine=None, model=None, calibration_data=None):
+        assert mode in QUANTIZE_MODES
+        engine = select_quantized_engine(engine)
+        if model is None:
+            model = create_model(base_name, **base_kwargs)
+        model = model.to("cpu").eval()
+        config = model.get_config()
+        super().__init__({"base_name": base_name, "base_kwargs": base_kwargs, "mode": mode, "engine": engine},
+                         scale=config["i2i_scale"], offset=config["i2i_offset"],
+                         in_channels=config["i2i_in_channels"], in_size=config["i2i_in_size"],
+                         blend_size=config["i2i_blend_size"])
+        self.base_name = base_name
+        self.mode = mode
+        self.engine = engine
+        with torch.no_grad():
+            if mode == "static":
+                self.net = _quantize_static(model, calibration_data, engine)
+            else:
+                self.net = _quantize_dynamic(model)
+
+    def forward(self, x):
+        return self.net(x)
+
+    def get_device(self):
+        return torch.device("cpu")
+
+
+def quantize_model(model, mode, calibration_data=None, engine=None):
+    """
+    Returns `QuantizedI2IModel` of the float `model`.
+    calibration_data: iterable of BCHW tensors for the static mode.
+    engine: quantized engine. None selects the first supported one of `QUANTIZED_ENGINES`.
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if mode == "static" and calibration_data is None:
+        raise ValueError("calibration_data is required for static quantization")
+    qmodel = QuantizedI2IModel(model.name, model.get_kwargs(), mode=mode, engine=engine,
+                               model=model, calibration_data=calibration_data)
+    logger.debug(f"quantize: {model.name}: {mode}, {qmodel.engine}")
+    return qmodel
@@ -24,7 +24,10 @@ def create_model(name, device_ids=None, **kwargs):
     if name not in _models:
         raise ValueError(f"Unknown model name: {name}")
     model = _models[name](**kwargs)
+    return place_model(model, device_ids)
 
+
+def place_model(model, device_ids=None):
     if device_ids is not None:
         if len(device_ids) > 1:
             name = model.name
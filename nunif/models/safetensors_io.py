@@ -0,0 +1,98 @@
+# Reader/Writer for the safetensors file layout, without the safetensors package.
+#   8 bytes: N, little-endian uint64, the size of the header
+#   N bytes: JSON header. {tensor_name: {"dtype": "F32", "shape": [...], "data_offsets": [begin, end]},
+#                          "__metadata__": {str: str}}
+#   rest:    tensor data. offsets are relative to the end of the header
+# The file is memory-mapped on load, so tensors are views of the page cache and are not copied.
+import os
+import json
+import mmap
+import struct
+import torch
+
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+HEADER_ALIGN = 8
+
+
+def save_safetensors(tensors, file_path, metadata=None):
+    """
+    tensors: dict of name -> tensor
+    metadata: dict of str -> str
+    """
+    # Larger elements first, so that every tensor is aligned to its element size without padding
+    names = sorted(tensors.keys(), key=lambda name: (-tensors[name].element_size(), name))
+    header = {}
+    offset = 0
+    for name in names:
+        t = tensors[name]
+        if t.dtype not in DTYPE_NAMES:
+            raise ValueError(f"{name}: unsupported dtype {t.dtype}")
+        nbytes = t.numel() * t.element_size()
+        header[name] = {"dtype": DTYPE_NAMES[t.dtype], "shape": list(t.shape),
+                        "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header["__metadata__"] = metadata
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # pad with spaces, so that the data starts at the aligned position
+    header += b" " * (-(8 + len(header)) % HEADER_ALIGN)
+
+    tmp_path = file_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in names:
+            t = tensors[name].detach().to("cpu").contiguous()
+            if t.numel() > 0:
+                f.write(t.view(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, file_path)
+
+
+def read_safetensors_header(file_path):
+    with open(file_path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    metadata = header.pop("__metadata__", None) or {}
+    return header, metadata, 8 + header_size
+
+
+def load_safetensors(file_path, use_mmap=True):
+    """
+    returns (dict of name -> tensor, metadata).
+    use_mmap: tensors are views of the memory-mapped file (copy-on-write). Otherwise the file is read.
+    """
+    header, metadata, data_start = read_safetensors_header(file_path)
+    with open(file_path, "rb") as f:
+        if use_mmap and os.path.getsize(file_path) > data_start:
+            # ACCESS_COPY: writable for torch, and writes are not reflected to the file
+            buffer = torch.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY), dtype=torch.uint8)
+        else:
+            buffer = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        data = buffer[data_start + begin:data_start + end]
+        if (data_start + begin) % torch.empty((), dtype=dtype).element_size() != 0:
+            # unaligned data written by other tools
+            data = data.clone()
+        tensors[name] = data.view(dtype).view(info["shape"])
+
+    return tensors, metadata
@@ -1,11 +1,22 @@
+import json
+import itertools
+from os import path
 import torch
 from datetime import datetime, timezone
 import torch.nn as nn
-from . register import create_model
+from . register import create_model, place_model
 from . model import Model
+from . safetensors_io import save_safetensors, load_safetensors
 from .. logger import logger
 
 
+SAFETENSORS_EXT = ".safetensors"
+
+
+def is_safetensors_file(model_path):
+    return path.splitext(model_path)[-1].lower() == SAFETENSORS_EXT
+
+
 def save_model(model, model_path, updated_at=None, train_kwargs=None, **kwargs):
     if isinstance(model, nn.DataParallel):
         model = model.module
@@ -30,10 +41,69 @@ def save_model(model, model_path, updated_at=None, train_kwargs=None, **kwargs):
         "train_kwargs": train_kwargs,
         "state_dict": model.state_dict()}
     data.update(kwargs)
-    torch.save(data, model_path)
+    if is_safetensors_file(model_path):
+        _save_safetensors_model(data, model_path)
+    else:
+        torch.save(data, model_path)
+
+
+def _save_safetensors_model(data, model_path):
+    # everything except state_dict is stored in the header as JSON
+    state_dict = data["state_dict"]
+    meta = {k: v for k, v in data.items() if k != "state_dict"}
+    save_safetensors(state_dict, model_path, metadata={"nunif": json.dumps(meta, default=str)})
+
+
+def _load_safetensors_model(model_path, model, device_ids, strict, map_location):
+    state_dict, metadata = load_safetensors(model_path)
+    if "nunif" not in metadata:
+        raise ValueError(f"{model_path}: not a nunif model file")
+    data = json.loads(metadata["nunif"])
+    if model is not None:
+        if isinstance(model, nn.DataParallel):
+            model.module.load_state_dict(state_dict, strict=strict)
+        else:
+            model.load_state_dict(state_dict, strict=strict)
+        return model, data
+
+    # Create the model without allocating and initializing parameters,
+    # and use the memory-mapped tensors as the parameters.
+    with torch.device("meta"):
+        model = create_model(data["name"], **data["kwargs"])
+    model.load_state_dict(state_dict, strict=strict, assign=True)
+    if any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+        # some parameters or buffers are not in the file
+        model = create_model(data["name"], **data["kwargs"])
+        model.load_state_dict(state_dict, strict=strict)
+    if device_ids is None and torch.device(map_location).type != "cpu":
+        model = model.to(map_location)
+    model = place_model(model, device_ids)
+
+    return model, data
+
+
+def convert_model_file(input_path, output_path):
+    """ Convert model file format by the extension of `output_path` (.pth or .safetensors)
+    """
+    model, data = load_model(input_path)
+    data.pop("nunif_model", None)
+    kwargs = {k: v for k, v in data.items() if k not in {"name", "kwargs", "updated_at", "train_kwargs"}}
+    save_model(model, output_path, updated_at=data.get("updated_at"),
+               train_kwargs=data.get("train_kwargs"), **kwargs)
 
 
 def load_model(model_path, model=None, device_ids=None, strict=True, map_location="cpu"):
+    """
+    The format is chosen by the extension. `.safetensors` files are memory-mapped,
+    and the tensors are used as the parameters without copying on CPU.
+    """
+    if is_safetensors_file(model_path):
+        model, data = _load_safetensors_model(model_path, model, device_ids, strict, map_location)
+        logger.debug(f"load: {model.name} from {model_path}")
+        if "updated_at" in data:
+            model.updated_at = data["updated_at"]
+        return model, data
+
     data = torch.load(model_path, map_location=map_location)
     assert ("nunif_model" in data)
     if model is None:
@@ -60,6 +130,19 @@ def load_model(model_path, model=None, device_ids=None, strict=True, map_locatio
     return model, data
 
 
+def share_model_memory(model):
+    """
+    Move the parameters and buffers to shared memory as read-only inference weights,
+    so that forked or spawned worker processes use the same physical memory. CPU only.
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    for t in itertools.chain(model.parameters(), model.buffers()):
+        t.requires_grad_(False)
+    model.share_memory()
+    return model
+
+
 def get_model_config(model, key=None):
     if isinstance(model, nn.DataParallel):
         model = model.module
@@ -1,27 +1,36 @@
 import torch
 
 
+# The helpers use negative dims so that they work for both CHW and BCHW.
+
 def _hflip(x):
-    return torch.flip(x, (2,))
+    return torch.flip(x, (-1,))
 
 
 def _vflip(x):
-    return torch.flip(x, (1,))
+    return torch.flip(x, (-2,))
 
 
 def _tr_f(x):
-    return torch.rot90(x, 1, (1, 2))
+    return torch.rot90(x, 1, (-2, -1))
 
 
 def _itr_f(x):
-    return torch.rot90(x, -1, (1, 2))
+    return torch.rot90(x, -1, (-2, -1))
 
 
-def tta_split(x):
-    assert (isinstance(x, torch.Tensor) and x.dim() == 3)
+TTA_LEVELS = (2, 4, 8)
+
+
+def _split(x, tta_level=8):
+    assert (tta_level in TTA_LEVELS)
     x_hflip = _hflip(x)
+    if tta_level == 2:
+        return (x, x_hflip)
     x_vflip = _vflip(x)
     x_vflip_hflip = _hflip(x_vflip)
+    if tta_level == 4:
+        return (x, x_hflip, x_vflip, x_vflip_hflip)
     x_tr = _tr_f(x)
     x_tr_hflip = _hflip(x_tr)
     x_tr_vflip = _vflip(x_tr)
@@ -31,18 +40,46 @@ def tta_split(x):
             x_tr, x_tr_hflip, x_tr_vflip, x_tr_vflip_hflip)
 
 
-def tta_merge(xs):
-    (x, x_hflip, x_vflip, x_vflip_hflip,
-     x_tr, x_tr_hflip, x_tr_vflip, x_tr_vflip_hflip) = xs
-
-    avg = x.clone()
-    avg += _hflip(x_hflip)
-    avg += _vflip(x_vflip)
-    avg += _vflip(_hflip(x_vflip_hflip))
-    avg += _itr_f(x_tr)
-    avg += _itr_f(_hflip(x_tr_hflip))
-    avg += _itr_f(_vflip(x_tr_vflip))
-    avg += _itr_f(_vflip(_hflip(x_tr_vflip_hflip)))
-    avg *= 1 / 8.0
+def _merge(xs):
+    # tta_level is the number of variants
+    assert (len(xs) in TTA_LEVELS)
+    avg = xs[0].clone()
+    avg += _hflip(xs[1])
+    if len(xs) >= 4:
+        avg += _vflip(xs[2])
+        avg += _vflip(_hflip(xs[3]))
+    if len(xs) == 8:
+        avg += _itr_f(xs[4])
+        avg += _itr_f(_hflip(xs[5]))
+        avg += _itr_f(_vflip(xs[6]))
+        avg += _itr_f(_vflip(_hflip(xs[7])))
+    avg *= 1 / len(xs)
 
     return torch.clamp_(avg, 0, 1)
+
+
+def tta_split(x, tta_level=8):
+    """ tta_level: 2: hflip, 4: hflip and vflip, 8: hflip, vflip and transpose
+    """
+    assert (isinstance(x, torch.Tensor) and x.dim() == 3)
+    return _split(x, tta_level)
+
+
+def tta_merge(xs):
+    return _merge(xs)
+
+
+def tta_split_batch(x, tta_level=8):
+    """ BCHW -> (tta_level*B)CHW. H and W must be the same for tta_level=8.
+    The variants are concatenated along the batch dimension, variant-major.
+    """
+    assert (isinstance(x, torch.Tensor) and x.dim() == 4)
+    assert (tta_level != 8 or x.shape[2] == x.shape[3])
+    return torch.cat(_split(x, tta_level), dim=0)
+
+
+def tta_merge_batch(z, tta_level=8):
+    """ (tta_level*B)CHW output of `tta_split_batch` input -> BCHW
+    """
+    assert (z.dim() == 4 and z.shape[0] % tta_level == 0)
+    return _merge(z.chunk(tta_level, dim=0))
@@ -56,3 +56,11 @@ class AlphaBorderPadding(nn.Module):
             mask_nega = mask < 1.
 
         return rgb.clamp_(0., 1.)
+
+
+def upscale_binary_alpha(alpha: torch.Tensor, scale_factor: int):
+    # Cheap edge-aware upscaling for binary alpha masks. alpha: BCHW
+    # Bilinear upscaling makes a ramp of `scale_factor` pixels at each edge,
+    # so the ramp is steepened back to about one output pixel, which keeps hard edges hard and antialiased.
+    z = F.interpolate(alpha, scale_factor=scale_factor, mode="bilinear", align_corners=False)
+    return z.sub_(0.5).mul_(scale_factor).add_(0.5).clamp_(0., 1.)
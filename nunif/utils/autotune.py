@@ -0,0 +1,170 @@
+# tile_size/batch_size autotuner for tiled_render
+import os
+from os import path
+import math
+import json
+import time
+import threading
+import torch
+from .. models import get_model_config, get_model_device
+from .. logger import logger
+
+
+DEFAULT_CACHE_FILE = path.join(path.expanduser("~"), ".cache", "nunif", "autotune.json")
+TILE_SIZES = (64, 112, 128, 160, 192, 208, 256, 304, 320, 352, 384, 400, 448, 512)
+BATCH_SIZES = (1, 2, 4, 8, 16)
+_cache_lock = threading.Lock()
+
+
+def is_out_of_memory(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e)
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _input_tile_step(model, tile_size):
+    scale = get_model_config(model, "i2i_scale")
+    offset = get_model_config(model, "i2i_offset")
+    blend_size = get_model_config(model, "i2i_blend_size") or 0
+    return tile_size - (math.ceil(offset / scale) * 2 + math.ceil(blend_size / scale))
+
+
+def is_valid_tile_size(model, tile_size):
+    """
+    Some architectures only accept specific input sizes,
+    e.g. swin_unet requires `(size - 16) % 12 == 0 and (size - 16) % 16 == 0`.
+    So it is checked with the model itself.
+    """
+    if _input_tile_step(model, tile_size) <= 0:
+        return False
+    scale = get_model_config(model, "i2i_scale")
+    offset = get_model_config(model, "i2i_offset")
+    in_channels = get_model_config(model, "i2i_in_channels") or 3
+    device = get_model_device(model)
+    x = torch.zeros((1, in_channels, tile_size, tile_size), device=device)
+    try:
+        with torch.no_grad():
+            z = model(x)
+    except (AssertionError, RuntimeError) as e:
+        if is_out_of_memory(e):
+            raise
+        return False
+    return z.shape[2:] == (tile_size * scale - offset * 2,) * 2
+
+
+def find_valid_tile_sizes(model, tile_sizes=TILE_SIZES):
+    return [tile_size for tile_size in tile_sizes if is_valid_tile_size(model, tile_size)]
+
+
+def benchmark(model, tile_size, batch_size, enable_amp=False, repeat=3):
+    """ returns the number of effective input pixels per second, or None if it does not fit in memory
+    """
+    device = get_model_device(model)
+    in_channels = get_model_config(model, "i2i_in_channels") or 3
+    step = _input_tile_step(model, tile_size)
+    try:
+        x = torch.rand((batch_size, in_channels, tile_size, tile_size), device=device)
+        with torch.no_grad(), torch.autocast(device_type=device.type, enabled=enable_amp):
+            model(x)  # warmup
+            _sync(device)
+            t = time.perf_counter()
+            for _ in range(repeat):
+                model(x)
+            _sync(device)
+            elapsed = time.perf_counter() - t
+    except RuntimeError as e:
+        if is_out_of_memory(e):
+            return None
+        raise
+    finally:
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    # The overlap of tiles is recomputed, so only the step area is counted
+    return (step * step * batch_size * repeat) / elapsed
+
+
+def device_name(device):
+    device = torch.device(device)
+    if device.type == "cuda":
+        return f"cuda:{torch.cuda.get_device_name(device)}"
+    return f"{device.type}:threads={torch.get_num_threads()}"
+
+
+def load_cache(cache_file):
+    if not path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"autotune: failed to load {cache_file}: {e}")
+        return {}
+
+
+def save_cache(cache_file, key, value):
+    with _cache_lock:
+        cache = load_cache(cache_file)
+        cache[key] = value
+        os.makedirs(path.dirname(path.abspath(cache_file)), exist_ok=True)
+        tmp_file = cache_file + f".{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_file, cache_file)
+
+
+def make_cache_key(model_file, device, enable_amp):
+    mtime = int(path.getmtime(model_file)) if path.exists(model_file) else 0
+    return f"{path.abspath(model_file)}:{mtime}:{device_name(device)}:amp={int(bool(enable_amp))}"
+
+
+def autotune(model, model_file=None, enable_amp=False,
+             tile_sizes=TILE_SIZES, batch_sizes=BATCH_SIZES,
+             cache_file=DEFAULT_CACHE_FILE, min_gain=1.05):
+    """
+    Benchmark valid (tile_size, batch_size) combinations for the model and
+    return the one with the highest pixels/second that fits in memory.
+    The result is cached in `cache_file` per model file and device.
+    """
+    device = get_model_device(model)
+    key = None
+    if model_file is not None and cache_file is not None:
+        key = make_cache_key(model_file, device, enable_amp)
+        cached = load_cache(cache_file).get(key)
+        if cached is not None:
+            logger.debug(f"autotune: load cache: {key}: {cached}")
+            return cached["tile_size"], cached["batch_size"]
+
+    best = None
+    for tile_size in find_valid_tile_sizes(model, tile_sizes):
+        tile_best = None
+        for batch_size in batch_sizes:
+            pps = benchmark(model, tile_size, batch_size, enable_amp=enable_amp)
+            logger.debug(f"autotune: tile_size={tile_size}, batch_size={batch_size}: "
+                         f"{round(pps) if pps is not None else 'out of memory'} px/s")
+            if pps is None:
+                break
+            prev_best = tile_best
+            if tile_best is None or pps > tile_best[0]:
+                tile_best = (pps, tile_size, batch_size)
+            if prev_best is not None and pps < prev_best[0] * min_gain:
+                # larger batch does not help any more
+                break
+        if tile_best is None:
+            # does not fit in memory. larger tiles do not fit either
+            break
+        if best is None or tile_best[0] > best[0]:
+            best = tile_best
+
+    if best is None:
+        raise RuntimeError("autotune: no valid tile_size")
+    _, tile_size, batch_size = best
+    logger.info(f"autotune: tile_size={tile_size}, batch_size={batch_size}, {round(best[0])} px/s")
+    if key is not None:
+        save_cache(cache_file, key, {"tile_size": tile_size, "batch_size": batch_size,
+                                     "pixels_per_second": best[0]})
+
+    return tile_size, batch_size
@@ -1,17 +1,291 @@
 import math
+import weakref
 import torch
 import torch.nn.functional as F
 from .. models import get_model_config, get_model_device
-from .seam_blending import SeamBlending
+from .. logger import logger
+from .autotune import TILE_SIZES, is_out_of_memory, is_valid_tile_size
+from .seam_blending import SeamBlending, RowStream, RenderCancelled, tile_forward, TILE_ORDERS  # noqa: F401
 
 
-def tiled_render(x, model, tile_size=256, batch_size=4, enable_amp=False):
+def tiled_render(x, model, tile_size=256, batch_size=4, enable_amp=False, pipeline=False, device_tiles=None,
+                 skip_uniform=False, uniform_tolerance=1. / 255., render_mask=None, fill_func=None,
+                 tta=False, tta_level=8, replicas=None, buffer_dtype=torch.float32, stats=None,
+                 progress=None, roi=None, tile_order="row"):
     return SeamBlending.tiled_render(
         x, model,
-        tile_size=tile_size, batch_size=batch_size, enable_amp=enable_amp)
+        tile_size=tile_size, batch_size=batch_size, enable_amp=enable_amp,
+        pipeline=pipeline, device_tiles=device_tiles,
+        skip_uniform=skip_uniform, uniform_tolerance=uniform_tolerance,
+        render_mask=render_mask, fill_func=fill_func, tta=tta, tta_level=tta_level,
+        replicas=replicas, buffer_dtype=buffer_dtype, stats=stats, progress=progress,
+        roi=roi, tile_order=tile_order)
 
 
-def simple_render(x, model, enable_amp=False):
+def tiled_render_rows(x, model, tile_size=256, batch_size=4, enable_amp=False, tta=False, tta_level=8,
+                      progress=None):
+    return SeamBlending.tiled_render_rows(
+        x, model,
+        tile_size=tile_size, batch_size=batch_size, enable_amp=enable_amp,
+        tta=tta, tta_level=tta_level, progress=progress)
+
+
+def tiled_render_cascade(x, models, tile_size=256, batch_size=4, enable_amp=False, tta=False, tta_level=8,
+                         progress=None):
+    """
+    Apply `models` in sequence, e.g. 4x with a 2x model twice.
+    The output rows of each pass are streamed into the tiles of the next pass with `tiled_render_rows()`,
+    so the intermediate images never exist in full, and only the final output is allocated (on `x.device`).
+    Peak memory is about a single tiled_render of the last pass.
+    progress: called for the tiles of the last pass, which drives the earlier passes.
+    """
+    assert not torch.is_grad_enabled()
+    output_device = x.device
+    C, H, W = x.shape
+    rows = None
+    for n, model in enumerate(models):
+        if rows is not None:
+            x = RowStream(rows, (C, H, W))
+        rows = tiled_render_rows(x, model, tile_size=tile_size, batch_size=batch_size, enable_amp=enable_amp,
+                                 tta=tta, tta_level=tta_level,
+                                 progress=progress if n == len(models) - 1 else None)
+        scale = get_model_config(model, "i2i_scale")
+        H, W = H * scale, W * scale
+
+    output = torch.empty((C, H, W), dtype=torch.float32, device=output_device)
+    for y, z in rows:
+        output[:, y:y + z.shape[1]] = z
+    return output
+
+
+def select_tile_size(x_size, model, tile_size, valid_tile_sizes=None):
+    """ returns the smallest valid tile size (<= tile_size) that covers the image with one tile, or `tile_size`.
+    valid_tile_sizes: dict to cache the result of `is_valid_tile_size`
+    """
+    scale = get_model_config(model, "i2i_scale")
+    offset = get_model_config(model, "i2i_offset")
+    if valid_tile_sizes is None:
+        valid_tile_sizes = {}
+    required = max(x_size) + math.ceil(offset / scale) * 2
+    for size in sorted(TILE_SIZES):
+        if required <= size <= tile_size:
+            if size not in valid_tile_sizes:
+                valid_tile_sizes[size] = is_valid_tile_size(model, size)
+            if valid_tile_sizes[size]:
+                return size
+    return tile_size
+
+
+def tiled_render_multi(xs, model, tile_size=256, batch_size=4, enable_amp=False):
+    """
+    tiled_render for many small images (icons, sprites).
+    Each image gets the smallest valid tile size that covers it, images are bucketed by the tile size,
+    and the tiles of the images in a bucket are packed into shared minibatches.
+    The outputs are blended into each image's own seam buffer.
+    xs: list of CHW tensors. returns the list of outputs in the same order.
+    """
+    assert not torch.is_grad_enabled()
+    scale = get_model_config(model, "i2i_scale")
+    offset = get_model_config(model, "i2i_offset")
+    blend_size = get_model_config(model, "i2i_blend_size") or 0
+    device = get_model_device(model)
+
+    valid_tile_sizes = {}
+    buckets = {}
+    for n, x in enumerate(xs):
+        size = select_tile_size(x.shape[1:], model, tile_size, valid_tile_sizes)
+        buckets.setdefault(size, []).append(n)
+
+    outputs = [None] * len(xs)
+    for size, bucket in buckets.items():
+        seam_blendings = {}
+        padded = {}
+        jobs = []
+        for n in bucket:
+            seam_blending = SeamBlending(xs[n].shape, scale=scale, offset=offset, tile_size=size,
+                                         blend_size=blend_size, device=device)
+            seam_blendings[n] = seam_blending
+            padded[n] = seam_blending.pad_input(xs[n].to(device))
+            jobs += [(n, index) for index in seam_blending.indexes]
+        # number of remaining tiles for each image, to free the buffers as soon as an image is done
+        remaining = {n: len(seam_blendings[n].indexes) for n in bucket}
+        for k in range(0, len(jobs), batch_size):
+            batch_jobs = jobs[k:k + batch_size]
+            tiles = []
+            for n, (h_i, w_i) in batch_jobs:
+                step = seam_blendings[n].input_tile_step
+                i, j = h_i * step, w_i * step
+                tiles.append(padded[n][:, i:i + size, j:j + size])
+            z = tile_forward(model, torch.stack(tiles), enable_amp=enable_amp)
+            # jobs are ordered by image, so each image is one run in the minibatch
+            start = 0
+            while start < len(batch_jobs):
+                n = batch_jobs[start][0]
+                end = start
+                while end < len(batch_jobs) and batch_jobs[end][0] == n:
+                    end += 1
+                seam_blendings[n].update_batch(z[start:end], [index for _, index in batch_jobs[start:end]])
+                remaining[n] -= end - start
+                if remaining[n] == 0:
+                    outputs[n] = seam_blendings.pop(n).get_output().contiguous()
+                    padded.pop(n)
+                start = end
+
+    return outputs
+
+
+def _chunk_priority(chunks, x, step, tile_size, h_blocks, w_blocks, priority):
+    # returns the chunk numbers in rendering order
+    if priority == "center":
+        ch, cw = (h_blocks - 1) * 0.5, (w_blocks - 1) * 0.5
+        scores = [min((h_i - ch) ** 2 + (w_i - cw) ** 2 for h_i, w_i in chunk) for chunk in chunks]
+    elif priority == "variance":
+        # color variance of tiles. flat regions look fine with the preview, so they are refined later
+        tiles = x.unfold(1, tile_size, step).unfold(2, tile_size, step)  # C x h_blocks x w_blocks x T x T
+        variance = tiles.var(dim=(3, 4)).sum(dim=0).cpu()
+        scores = [-max(variance[h_i, w_i].item() for h_i, w_i in chunk) for chunk in chunks]
+    else:
+        raise ValueError(f"Unknown priority: {priority}")
+    return sorted(range(len(chunks)), key=lambda n: scores[n])
+
+
+def progressive_render(x, model, tile_size=256, batch_size=4, enable_amp=False, priority="center",
+                       preview_mode="bicubic"):
+    """
+    Progressive version of tiled_render for interactive use.
+    Yields `(done, total, y)`. The first `y` is a cheap upscale of `x` (`preview_mode` for F.interpolate),
+    then the model output of tiles is pasted on it in the `priority` order ("center" or "variance").
+    The last `y` is the blended output, which is bit-identical to `tiled_render()`
+    with the same tile_size/batch_size/enable_amp.
+    `y` is updated in place, so copy it to keep a snapshot.
+
+    To get the same output, tiles are rendered in the same minibatches as tiled_render,
+    and the minibatches are blended in the same order. Model outputs that cannot be blended yet
+    are kept until the previous minibatches are done, so the peak memory is higher than tiled_render.
+    """
+    assert not torch.is_grad_enabled()
+    C, H, W = x.shape
+    scale = get_model_config(model, "i2i_scale")
+    offset = get_model_config(model, "i2i_offset")
+    blend_size = get_model_config(model, "i2i_blend_size") or 0
+    device = get_model_device(model)
+    seam_blending = SeamBlending(x.shape, scale=scale, offset=offset, tile_size=tile_size,
+                                 blend_size=blend_size, device=device)
+    seam_blending.eval()
+    step = seam_blending.input_tile_step
+    output_step = seam_blending.output_tile_step
+
+    if scale > 1:
+        preview = F.interpolate(x.unsqueeze(0).to(device), scale_factor=scale, mode=preview_mode,
+                                align_corners=False)[0].clamp_(0, 1)
+    else:
+        preview = x.to(device, copy=True)
+    indexes = seam_blending.indexes
+    chunks = [indexes[k:k + batch_size] for k in range(0, len(indexes), batch_size)]
+    total = len(indexes)
+    done = 0
+    yield done, total, preview
+
+    if SeamBlending.can_pad_on_device(x, seam_blending.pad, device):
+        x = x.to(device)
+    x = seam_blending.pad_input(x)
+    pending = {}
+    next_chunk = 0
+    for n in _chunk_priority(chunks, x, step, tile_size,
+                             seam_blending.h_blocks, seam_blending.w_blocks, priority):
+        for minibatch, output_indexes in SeamBlending._device_minibatches(
+                x, chunks[n], step, tile_size, batch_size):
+            z = tile_forward(model, minibatch.to(device), enable_amp=enable_amp)
+        pending[n] = z
+        # blend in the same order as tiled_render
+        while next_chunk in pending:
+            seam_blending.update_batch(pending.pop(next_chunk), chunks[next_chunk])
+            next_chunk += 1
+
+        # paste the unblended tiles on the preview
+        for k, (h_i, w_i) in enumerate(chunks[n]):
+            i, j = h_i * output_step, w_i * output_step
+            if i < preview.shape[1] and j < preview.shape[2]:
+                h, w = min(z.shape[2], preview.shape[1] - i), min(z.shape[3], preview.shape[2] - j)
+                preview[:, i:i + h, j:j + w] = z[k, :, 0:h, 0:w]
+        done += len(chunks[n])
+        if done < total:
+            yield done, total, preview
+
+    yield total, total, seam_blending.get_output().contiguous()
+
+
+_activation_cache = weakref.WeakKeyDictionary()
+
+
+def estimate_activation_bytes(model, enable_amp=False):
+    """
+    Estimate the activation memory per input pixel for a whole-image forward pass.
+    The output sizes of all leaf modules are recorded with forward hooks on a small probe input.
+    Intermediate tensors may be freed during the forward pass, so the sum is an upper bound.
+    """
+    key = bool(enable_amp)
+    cached = _activation_cache.get(model, {})
+    if key in cached:
+        return cached[key]
+
+    device = get_model_device(model)
+    in_channels = get_model_config(model, "i2i_in_channels") or 3
+    total_bytes = 0
+
+    def hook(module, inputs, output):
+        nonlocal total_bytes
+        if isinstance(output, torch.Tensor):
+            total_bytes += output.numel() * output.element_size()
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()
+               if len(list(module.children())) == 0]
+    try:
+        for probe_size in TILE_SIZES:
+            # some architectures only accept specific input sizes
+            total_bytes = 0
+            x = torch.zeros((1, in_channels, probe_size, probe_size), device=device)
+            try:
+                with torch.no_grad(), torch.autocast(device_type=device.type, enabled=enable_amp):
+                    model(x)
+            except (AssertionError, RuntimeError) as e:
+                if is_out_of_memory(e):
+                    raise
+                continue
+            break
+        else:
+            raise RuntimeError("estimate_activation_bytes: no valid probe size")
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    bytes_per_pixel = total_bytes / (probe_size * probe_size)
+    _activation_cache.setdefault(model, {})[key] = bytes_per_pixel
+    return bytes_per_pixel
+
+
+def available_memory(device):
+    device = torch.device(device)
+    if device.type == "cuda":
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        return free_bytes
+    import psutil
+    return psutil.virtual_memory().available
+
+
+def can_render_whole(x, model, enable_amp=False, max_usage=0.5):
+    """ returns True if the whole image forward pass is expected to fit in `max_usage` of the free memory
+    """
+    scale = get_model_config(model, "i2i_scale")
+    offset = get_model_config(model, "i2i_offset")
+    input_offset = math.ceil(offset / scale)
+    pixels = (x.shape[-2] + input_offset * 2) * (x.shape[-1] + input_offset * 2)
+    batch = x.shape[0] if x.dim() == 4 else 1
+    required = estimate_activation_bytes(model, enable_amp) * pixels * batch
+    return required < available_memory(get_model_device(model)) * max_usage
+
+
+def _simple_render(x, model, enable_amp=False):
     scale = get_model_config(model, "i2i_scale")
     offset = get_model_config(model, "i2i_offset")
     device = get_model_device(model)
@@ -28,3 +302,45 @@ def simple_render(x, model, enable_amp=False):
     if not minibatch:
         z = z.squeeze(0)
     return z
+
+
+def _tiled_render_fallback(x, model, tile_size, batch_size, enable_amp):
+    # retry with smaller tiles on out of memory
+    tile_sizes = [size for size in sorted(TILE_SIZES, reverse=True) if size <= tile_size]
+    for size in tile_sizes:
+        if not is_valid_tile_size(model, size):
+            continue
+        try:
+            logger.debug(f"simple_render: tiled render with tile_size={size}")
+            return tiled_render(x, model, tile_size=size, batch_size=batch_size, enable_amp=enable_amp)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            _empty_cache(model)
+            batch_size = 1
+    raise RuntimeError("simple_render: out of memory with the smallest tile size")
+
+
+def _empty_cache(model):
+    if get_model_device(model).type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def simple_render(x, model, enable_amp=False, auto_tiled=True, tile_size=256, batch_size=4):
+    """
+    Whole-image forward pass.
+    auto_tiled: for a single CHW image, use tiled_render instead when the estimated activation memory
+                does not fit in the free memory, or when the forward pass runs out of memory.
+                The tiles are made smaller on out of memory.
+    """
+    tileable = auto_tiled and x.dim() == 3 and get_model_config(model, "i2i_in_size") is None
+    if tileable and not can_render_whole(x, model, enable_amp):
+        return _tiled_render_fallback(x, model, tile_size, batch_size, enable_amp)
+    try:
+        return _simple_render(x, model, enable_amp)
+    except RuntimeError as e:
+        if not (tileable and is_out_of_memory(e)):
+            raise
+        logger.debug("simple_render: out of memory. fallback to tiled render")
+        _empty_cache(model)
+    return _tiled_render_fallback(x, model, tile_size, batch_size, enable_amp)
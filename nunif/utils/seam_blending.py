@@ -1,19 +1,284 @@
 import math
+from functools import lru_cache
 import torch
 import torch.nn.functional as F
 from .. models import get_model_config, get_model_device
+from .. logger import logger
+from .. transforms.tta import tta_split_batch, tta_merge_batch
+
+
+class RenderCancelled(Exception):
+    """ Raised by tiled_render when the progress callback requests cancellation.
+    """
+    pass
+
+
+def tile_forward(model, minibatch, enable_amp=False, tta=False, tta_level=8, max_batch_size=None):
+    """ max_batch_size: the maximum number of model inputs for one forward pass.
+                        With tta, the variants are split across forward passes when they exceed it.
+    """
+    device = minibatch.device
+    with torch.autocast(device_type=device.type, enabled=enable_amp):
+        if tta:
+            x = tta_split_batch(minibatch, tta_level)
+            if max_batch_size is not None and x.shape[0] > max_batch_size:
+                z = torch.cat([model(x[k:k + max_batch_size]) for k in range(0, x.shape[0], max_batch_size)])
+            else:
+                z = model(x)
+            return tta_merge_batch(z, tta_level)
+        else:
+            return model(minibatch)
+
+
+TILE_ORDERS = ("row", "zorder", "hilbert", "column")
+
+
+def _zorder_key(h_i, w_i):
+    # interleave the bits of h_i and w_i
+    key = 0
+    for bit in range(max(h_i.bit_length(), w_i.bit_length())):
+        key |= ((w_i >> bit) & 1) << (2 * bit)
+        key |= ((h_i >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def _hilbert_key(n, h_i, w_i):
+    # distance along the hilbert curve on n x n grid. n is a power of 2
+    key = 0
+    s = n // 2
+    while s > 0:
+        rh = 1 if (h_i & s) > 0 else 0
+        rw = 1 if (w_i & s) > 0 else 0
+        key += s * s * ((3 * rw) ^ rh)
+        # rotate the quadrant
+        if rh == 0:
+            if rw == 1:
+                h_i, w_i = s - 1 - h_i, s - 1 - w_i
+            h_i, w_i = w_i, h_i
+        s //= 2
+    return key
+
+
+def order_tiles(indexes, order="row", strip_width=4):
+    """
+    Sort tile indexes in the traversal order.
+    row: row-major.
+    zorder: Z-order (Morton order) curve.
+    hilbert: Hilbert curve.
+    column: column strips of `strip_width` tiles. row-major in each strip.
+    The neighbor tiles of the non row-major orders are rendered close in time,
+    so the blend regions of the seam blending buffer are still in the cache when the neighbor is added.
+    The result is the same except for the float rounding of the summation order.
+    """
+    assert order in TILE_ORDERS
+    if order == "row":
+        return sorted(indexes)
+    elif order == "zorder":
+        return sorted(indexes, key=lambda index: _zorder_key(*index))
+    elif order == "hilbert":
+        n = 1
+        for h_i, w_i in indexes:
+            while n <= max(h_i, w_i):
+                n *= 2
+        return sorted(indexes, key=lambda index: _hilbert_key(n, *index))
+    elif order == "column":
+        return sorted(indexes, key=lambda index: (index[1] // strip_width, index[0], index[1]))
+
+
+class TileStaging():
+    """ Rotating host buffers for the tile minibatch.
+    On CUDA, the buffers are pinned and each upload is issued as a non-blocking copy on a side stream,
+    so that the next minibatch can be copied while the model runs on the current one.
+    On other devices, the buffers are used as is.
+    """
+    def __init__(self, shape, device, num_buffers=2):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.buffers = [torch.zeros(shape, pin_memory=self.use_cuda) for _ in range(num_buffers)]
+        self.events = [None] * num_buffers
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        self.index = -1
+
+    def next_buffer(self):
+        self.index = (self.index + 1) % len(self.buffers)
+        if self.events[self.index] is not None:
+            # wait for the previous upload from this buffer
+            self.events[self.index].synchronize()
+            self.events[self.index] = None
+        return self.buffers[self.index]
+
+    def upload(self, n):
+        x = self.buffers[self.index][0:n]
+        if not self.use_cuda:
+            return x, None
+        with torch.cuda.stream(self.stream):
+            x = x.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.events[self.index] = event
+        return x, event
+
+    def wait(self, upload):
+        x, event = upload
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # x was allocated on the side stream
+            x.record_stream(stream)
+        return x
+
+
+class RowStream():
+    """ CHW image given as the `(y, rows)` stream of `tiled_render_rows()`, used as the input of another
+    `tiled_render_rows()`. Rows are pulled from the stream on demand, and only the rows that the current
+    band of tiles needs are kept, so the whole image never exists.
+    The requested rows must not go backward. `tiled_render_rows()` requests them from top to bottom.
+    """
+    def __init__(self, rows, shape):
+        self.rows = iter(rows)
+        self.shape = tuple(shape)
+        self.buffer = None
+        self.top = 0
+        self.bottom = 0
+
+    def take_rows(self, row_index):
+        first, last = int(row_index.min()), int(row_index.max())
+        assert first >= self.top
+        parts = [] if self.buffer is None else [self.buffer[:, first - self.top:]]
+        self.top = first
+        while self.bottom <= last:
+            y, rows = next(self.rows)
+            assert y == self.bottom
+            parts.append(rows)
+            self.bottom += rows.shape[1]
+        # the rows above `first` are released here
+        self.buffer = torch.cat(parts, dim=1) if len(parts) > 1 else parts[0].clone()
+        return self.buffer.index_select(1, row_index.to(self.buffer.device) - self.top)
+
+
+class RenderPlan():
+    """ Tile layout, padding, blend filter and the sum of blend weights for one row of tiles,
+    for an image size and a tile config.
+    They do not depend on the image content, so a plan is shared by renders of the same size
+    (batch folders, video frames, web requests). See `get_render_plan()`.
+    The tensors are shared, so do not modify them.
+    The plan does not hold tensors of the full output size, because plans are kept in the cache.
+    The weights for the whole buffer are created for each render with `create_weights()`.
+    """
+    def __init__(self, x_size, scale, offset, tile_size, blend_size, device):
+        config = SeamBlending.create_config(x_size, scale, offset, tile_size, blend_size)
+        self.output_tile_step = config["output_tile_step"]
+        self.input_tile_step = config["input_tile_step"]
+        self.h_blocks = config["h_blocks"]
+        self.w_blocks = config["w_blocks"]
+        self.y_h = config["y_h"]
+        self.y_w = config["y_w"]
+        self.y_buffer_h = config["y_buffer_h"]
+        self.y_buffer_w = config["y_buffer_w"]
+        self.pad = config["pad"]
+        self.indexes = tuple((h_i, w_i) for h_i in range(self.h_blocks) for w_i in range(self.w_blocks))
+        self.device = device
+        if blend_size > 0:
+            blend_filter = SeamBlending.create_blend_filter(scale, offset, tile_size, blend_size, 1).to(device)
+            self.blend_filter = blend_filter
+            # The sum of blend filters for one row of tiles. Used as is in band mode.
+            self.row_weights = self._fold_row_weights(self.w_blocks).contiguous()
+        else:
+            self.blend_filter = self.row_weights = None
+
+    def _fold_row_weights(self, w_blocks):
+        _, H, W = self.blend_filter.shape
+        return SeamBlending._fold_row(self.blend_filter.unsqueeze(0).expand(w_blocks, 1, H, W),
+                                      self.output_tile_step)
+
+    def create_weights(self, h_blocks, w_blocks, buffer_h, buffer_w, dtype=torch.float32):
+        """ returns the sum of blend filters for the grid of `h_blocks x w_blocks` tiles in the buffer size.
+        All rows are the same, so it is folded from one row along H.
+        It is the size of the buffer, so it is not cached.
+        """
+        row_weights = self.row_weights if w_blocks == self.w_blocks else self._fold_row_weights(w_blocks)
+        columns = row_weights.transpose(1, 2).unsqueeze(0).expand(h_blocks, -1, -1, -1)
+        folded = SeamBlending._fold_row(columns, self.output_tile_step).transpose(1, 2)
+        weights = torch.zeros((1, buffer_h, buffer_w), dtype=dtype, device=self.device)
+        weights[:, 0:folded.shape[1], 0:folded.shape[2]] = folded
+        return weights
+
+
+@lru_cache(maxsize=8)
+def _get_render_plan(x_size, scale, offset, tile_size, blend_size, device):
+    return RenderPlan(x_size, scale, offset, tile_size, blend_size, device)
+
+
+def get_render_plan(x_size, scale, offset, tile_size, blend_size, device="cpu"):
+    """ returns a cached RenderPlan. x_size: (H, W)
+    """
+    return _get_render_plan(tuple(x_size), scale, offset, tile_size, blend_size, torch.device(device))
 
 
 class SeamBlending(torch.nn.Module):
-    def __init__(self, x_shape, scale, offset, tile_size, blend_size):
+    def __init__(self, x_shape, scale, offset, tile_size, blend_size, band=False, dtype=torch.float32,
+                 device="cpu", roi=None):
+        """
+        band: allocate the buffers for one row of tiles only. See `advance()`.
+        roi: (top, left, height, width) region of the input image.
+             The buffers cover only the tiles of the full image tile grid that overlap the region,
+             and block indexes are relative to the first of them. `get_output()` returns the region,
+             which is the same as the crop of the full output. See `pad_input()` for the input.
+        device: device of the buffers. The plan for the image size is taken from the cache on this device.
+        dtype: dtype of the accumulation buffers. torch.float16 or torch.bfloat16 for lower memory.
+               The blend filter is the same for all channels, so the weight buffer is single-channel,
+               and the half precision buffers need 3x less memory than float32 for RGB.
+               The products of tiles and the blend filter are computed in float32 and rounded
+               once per accumulation, so the error of an output pixel against float32 is at most
+               about `n * eps`, where `n` (<= 4) is the number of overlapping tiles at that pixel
+               and `eps` is 2^-11 for float16 and 2^-8 for bfloat16.
+               With float16, 8-bit output differs from float32 by at most 1 level, only near rounding boundaries.
+               With bfloat16, 8-bit output differs by up to 2 levels on a few percent of the pixels.
+               See `_test_buffer_dtype()`.
+        """
         super().__init__()
 
         C, H, W = x_shape
-        config = SeamBlending.create_config((H, W), scale, offset, tile_size, blend_size)
-        pixels = torch.zeros((C, config["y_buffer_h"], config["y_buffer_w"]), dtype=torch.float32)
+        plan = get_render_plan((H, W), scale, offset, tile_size, blend_size, device)
+        output_tile_size = tile_size * scale - offset * 2
+        step = plan.output_tile_step
+        if roi is not None:
+            assert not band
+            top, left, height, width = roi
+            assert 0 <= top and 0 <= left and 0 < height and 0 < width and top + height <= H and left + width <= W
+            # blocks [h0, h1) x [w0, w1) that overlap the region in the output
+            h0 = max((top * scale - output_tile_size) // step + 1, 0)
+            h1 = min(((top + height) * scale - 1) // step + 1, plan.h_blocks)
+            w0 = max((left * scale - output_tile_size) // step + 1, 0)
+            w1 = min(((left + width) * scale - 1) // step + 1, plan.w_blocks)
+            self.block_range = (h0, h1, w0, w1)
+            self.h_blocks = h1 - h0
+            self.w_blocks = w1 - w0
+            self.output_origin = (top * scale - h0 * step, left * scale - w0 * step)
+            self.y_h = height * scale
+            self.y_w = width * scale
+            buffer_h = (self.h_blocks - 1) * step + output_tile_size
+            buffer_w = (self.w_blocks - 1) * step + output_tile_size
+        else:
+            self.block_range = None
+            self.h_blocks = plan.h_blocks
+            self.w_blocks = plan.w_blocks
+            self.output_origin = (0, 0)
+            self.y_h = plan.y_h
+            self.y_w = plan.y_w
+            buffer_h = output_tile_size if band else plan.y_buffer_h
+            buffer_w = plan.y_buffer_w
+
+        pixels = torch.zeros((C, buffer_h, buffer_w), dtype=dtype, device=plan.device)
         if blend_size > 0:
-            weights = torch.zeros((C, config["y_buffer_h"], config["y_buffer_w"]), dtype=torch.float32)
-            blend_filter = SeamBlending.create_blend_filter(scale, offset, tile_size, blend_size, C)
+            if band:
+                # the row weights are added for each row. See `advance()`
+                weights = torch.zeros((1, buffer_h, buffer_w), dtype=dtype, device=plan.device)
+            else:
+                # With roi, the weights of the block range are the same as the full tile grid in the region,
+                # because all tiles that overlap the region are rendered.
+                weights = plan.create_weights(self.h_blocks, self.w_blocks, buffer_h, buffer_w, dtype=dtype)
+            blend_filter = plan.blend_filter
         else:
             weights = None
             blend_filter = None
@@ -21,30 +286,168 @@ class SeamBlending(torch.nn.Module):
         self.register_buffer("pixels", pixels)
         self.register_buffer("weights", weights)
         self.register_buffer("blend_filter", blend_filter)
-        self.output_tile_step = config["output_tile_step"]
-        self.input_tile_step = config["input_tile_step"]
-        self.h_blocks = config["h_blocks"]
-        self.w_blocks = config["w_blocks"]
-        self.y_h = config["y_h"]
-        self.y_w = config["y_w"]
-        self.pad = config["pad"]
+        self.plan = plan
+        self.output_tile_step = plan.output_tile_step
+        self.input_tile_step = plan.input_tile_step
+        self.pad = plan.pad
+        self.tile_size = tile_size
         self.blend_size = blend_size
+        self.band = band
+        if blend_size > 0 and band:
+            self._add_row_weights(0)
 
     def forward(self, x: torch.Tensor, i: int, j: int):
-        return SeamBlending.update(
-            x, self.blend_filter, self.output_tile_step, self.blend_size,
-            self.pixels, self.weights, i, j)
+        return self.update_batch(x.unsqueeze(0), [(i, j)])
+
+    @property
+    def indexes(self):
+        if self.block_range is None:
+            return self.plan.indexes
+        return [(h_i, w_i) for h_i in range(self.h_blocks) for w_i in range(self.w_blocks)]
+
+    def pad_input(self, x):
+        """ x: CHW input image (or 1HW mask) -> padded input for the tile grid.
+        With `roi`, only the part for the blocks that overlap the region is taken,
+        with real neighboring pixels and replicate padding at the image border.
+        """
+        if self.block_range is None:
+            return F.pad(x.unsqueeze(0), self.pad, mode='replicate')[0]
+        h0, h1, w0, w1 = self.block_range
+        pad_left, _, pad_top, _ = self.pad
+        step = self.input_tile_step
+        # replicate padding by clamping the indexes
+        row_index = torch.arange(h0 * step - pad_top, (h1 - 1) * step + self.tile_size - pad_top,
+                                 device=x.device).clamp_(0, x.shape[1] - 1)
+        col_index = torch.arange(w0 * step - pad_left, (w1 - 1) * step + self.tile_size - pad_left,
+                                 device=x.device).clamp_(0, x.shape[2] - 1)
+        return x.index_select(1, row_index).index_select(2, col_index)
+
+    @staticmethod
+    def _fold_row(z, step, accumulate=True):
+        # z: BCHW tiles at consecutive w-blocks of the same row -> C x H x W' strip.
+        # Overlapping columns are summed when `accumulate=True`, otherwise the later tile overwrites them.
+        # Each tile is split at the step size, so the strip is built with a few batched copies
+        # instead of one slice update per tile.
+        B, C, H, W = z.shape
+        if B == 1:
+            return z[0]
+        overlap = W - step
+        strip = z.new_zeros((C, H, (B + 1) * step))
+        if overlap > step:
+            # tile_size is too small to split tiles at the step size
+            for k in range(B):
+                if accumulate:
+                    strip[:, :, k * step:k * step + W] += z[k]
+                else:
+                    strip[:, :, k * step:k * step + W] = z[k]
+            return strip[:, :, 0:(B - 1) * step + W]
+        strip[:, :, 0:B * step] = z[:, :, :, 0:step].permute(1, 2, 0, 3).reshape(C, H, B * step)
+        if overlap > 0:
+            if accumulate:
+                tail = strip[:, :, step:(B + 1) * step].view(C, H, B, step)
+                tail[:, :, :, 0:overlap] += z[:, :, :, step:].permute(1, 2, 0, 3)
+            else:
+                strip[:, :, B * step:B * step + overlap] = z[-1, :, :, step:]
+        return strip[:, :, 0:(B - 1) * step + W]
+
+    def _add_row_weights(self, h_i):
+        # band mode: the sum of blend filters for a tile row is precomputed by the plan
+        row = self.plan.row_weights
+        i = h_i * self.output_tile_step
+        self.weights[:, i:i + row.shape[1], 0:row.shape[2]] += row
+
+    def update_batch(self, z: torch.Tensor, indexes):
+        # z: BCHW model outputs, indexes: (h_i, w_i) block index for each z[k]
+        # Tiles are blended with one strip per run of consecutive tiles in the same row,
+        # instead of several slice reads and writes per tile.
+        H, W = z.shape[2:]
+        if self.blend_size > 0:
+            assert self.blend_filter.shape[1:] == z.shape[2:]
+            z = z.to(torch.float32) * self.blend_filter.unsqueeze(0)
+        else:
+            z = z.to(self.pixels.dtype)
+        start = 0
+        while start < len(indexes):
+            h_i, w_i = indexes[start]
+            end = start + 1
+            while end < len(indexes) and indexes[end] == (h_i, w_i + end - start):
+                end += 1
+            strip = self._fold_row(z[start:end], self.output_tile_step, accumulate=self.blend_size > 0)
+            i = h_i * self.output_tile_step
+            j = w_i * self.output_tile_step
+            if self.blend_size > 0:
+                # Accumulate the weighted sum of tiles. get_output() normalizes it by the sum of weights.
+                self.pixels[:, i:i + H, j:j + strip.shape[2]] += strip
+            else:
+                # No blending
+                self.pixels[:, i:i + H, j:j + strip.shape[2]] = strip
+            start = end
 
     def get_output(self):
-        return torch.clamp(self.pixels[:, 0:self.y_h, 0:self.y_w], 0., 1.)
+        i, j = self.output_origin
+        pixels = self.pixels[:, i:i + self.y_h, j:j + self.y_w].to(torch.float32)
+        if self.blend_size > 0:
+            pixels = pixels / self.weights[:, i:i + self.y_h, j:j + self.y_w].to(torch.float32)
+        return torch.clamp(pixels, 0., 1.)
 
     def clear(self):
-        if self.weights is not None:
-            self.weights.zero_()
         self.pixels.zero_()
 
+    def get_band_output(self, rows):
+        # band mode: the first `rows` rows of the band, clipped to the output size
+        pixels = self.pixels[:, 0:rows, 0:self.y_w].to(torch.float32)
+        if self.blend_size > 0:
+            pixels = pixels / self.weights[:, 0:rows, 0:self.y_w].to(torch.float32)
+        return torch.clamp(pixels, 0., 1.)
+
+    def advance(self):
+        # band mode: move to the next row of tiles.
+        # The rows overlapped by the next band are kept, the finished rows are discarded.
+        assert self.band
+        step = self.output_tile_step
+        H = self.pixels.shape[1]
+        self.pixels[:, 0:H - step] = self.pixels[:, step:H].clone()
+        self.pixels[:, H - step:H] = 0
+        if self.blend_size > 0:
+            self.weights[:, 0:H - step] = self.weights[:, step:H].clone()
+            self.weights[:, H - step:H] = 0
+            self._add_row_weights(0)
+
     @staticmethod
-    def tiled_render(x, model, tile_size=256, batch_size=4, enable_amp=True):
+    def tiled_render(x, model, tile_size=256, batch_size=4, enable_amp=True, pipeline=False, device_tiles=None,
+                     skip_uniform=False, uniform_tolerance=1. / 255., render_mask=None, fill_func=None,
+                     tta=False, tta_level=8, replicas=None, buffer_dtype=torch.float32, stats=None,
+                     progress=None, roi=None, tile_order="row"):
+        """
+        pipeline: upload minibatches with pinned double buffering. Used when tiles are taken on the host.
+        device_tiles: upload the whole image once and take tiles on the device.
+                      None for auto, which chooses it when the padded image fits in device memory.
+        skip_uniform: do not run the model for each single-color tile (within `uniform_tolerance`).
+                      Such tiles are filled with the model output for a constant tile of that color,
+                      which is computed once per color.
+        render_mask: 1HW bool mask. Tiles that have no True pixel are filled with `fill_func`
+                     instead of the model, e.g. `alpha > 0` to skip fully transparent tiles.
+        fill_func: function that upscales a BCHW minibatch of tiles by the model scale.
+                   bilinear resampling by default.
+        tta: geometric ensemble for each tile. The variants of tiles are processed
+             in one minibatch and merged right after the forward pass,
+             so the seam blending buffer is shared.
+             `batch_size` is the number of model inputs, so `batch_size // tta_level` tiles are taken at once.
+             When `batch_size < tta_level`, the variants of a tile are split across forward passes.
+        tta_level: the number of TTA variants. 2, 4 or 8.
+        replicas: `tile_sharding.DeviceReplicas` or `tile_sharding.ProcessReplicas`.
+                  Tile minibatches are spread across the model replicas,
+                  and the outputs are blended in the same order as the single model.
+        buffer_dtype: dtype of the seam blending buffers. See `SeamBlending.__init__`.
+        stats: dict to receive the number of tiles and skipped tiles.
+        progress: callback `progress(done, total)` called with the number of finished tiles,
+                  once before rendering and after each minibatch.
+                  When it returns True, rendering is stopped and `RenderCancelled` is raised.
+        roi: (top, left, height, width) region of the input image to render.
+             Only the tiles that overlap the region are rendered, with the same tile grid and context pixels
+             as the full image, so the output is the same as the crop of the full output.
+        tile_order: traversal order of tiles. See `order_tiles`.
+        """
         assert not torch.is_grad_enabled()
         C, H, W = x.shape
         scale = get_model_config(model, "i2i_scale")
@@ -55,35 +458,247 @@ class SeamBlending(torch.nn.Module):
         device = get_model_device(model)
         seam_blending = SeamBlending(x.shape, scale=scale,
                                      offset=offset, tile_size=tile_size,
-                                     blend_size=blend_size).to(device)
+                                     blend_size=blend_size, dtype=buffer_dtype, device=device, roi=roi)
         seam_blending.eval()
-        minibatch_index = 0
-        minibatch = torch.zeros((batch_size, C, tile_size, tile_size))
-        output_indexes = [None] * batch_size
+        step = seam_blending.input_tile_step
+        model_batch_size = batch_size
+        if tta:
+            batch_size = max(batch_size // tta_level, 1)
 
-        x = F.pad(x.unsqueeze(0), seam_blending.pad, mode='replicate')[0]
-        for h_i in range(seam_blending.h_blocks):
-            for w_i in range(seam_blending.w_blocks):
-                i = h_i * seam_blending.input_tile_step
-                j = w_i * seam_blending.input_tile_step
-                minibatch[minibatch_index] = x[:, i:i + tile_size, j:j + tile_size]
-                output_indexes[minibatch_index] = (h_i, w_i)
-                minibatch_index += 1
-                if minibatch_index == batch_size:
-                    with torch.autocast(device_type=device.type, enabled=enable_amp):
-                        z = model(minibatch.to(device))
-                    for k in range(minibatch_index):
-                        seam_blending(z[k], output_indexes[k][0], output_indexes[k][1])
-                    minibatch_index = 0
-
-        if minibatch_index > 0:
-            with torch.autocast(device_type=device.type, enabled=enable_amp):
-                z = model(minibatch[0:minibatch_index].to(device))
-            for k in range(minibatch_index):
-                seam_blending(z[k], output_indexes[k][0], output_indexes[k][1])
+        indexes = seam_blending.indexes
+        if device_tiles is None:
+            device_tiles = SeamBlending.can_pad_on_device(x, seam_blending.pad, device)
+        if device_tiles:
+            x = x.to(device)
+            render_mask = render_mask.to(device) if render_mask is not None else None
+        x = seam_blending.pad_input(x)
+
+        def minibatches(indexes):
+            if device_tiles:
+                return SeamBlending._device_minibatches(x, indexes, step, tile_size, batch_size)
+            elif pipeline:
+                return SeamBlending._pipeline_minibatches(x, indexes, step, tile_size, batch_size, device)
+            else:
+                return SeamBlending._minibatches(x, indexes, step, tile_size, batch_size, device)
+
+        uniform_tiles, masked_tiles = {}, []
+        if skip_uniform or render_mask is not None:
+            if render_mask is not None:
+                render_mask = seam_blending.pad_input(render_mask.to(torch.float32))
+            uniform_tiles, masked_tiles = SeamBlending.find_skip_tiles(
+                x, step, tile_size,
+                uniform_tolerance=uniform_tolerance if skip_uniform else None, render_mask=render_mask)
+            skip_indexes = set(masked_tiles)
+            for _, color_indexes in uniform_tiles.values():
+                skip_indexes.update(color_indexes)
+            indexes = [index for index in indexes if index not in skip_indexes]
+        if tile_order != "row":
+            indexes = order_tiles(indexes, tile_order)
+
+        def forward(minibatch):
+            return tile_forward(model, minibatch, enable_amp=enable_amp, tta=tta, tta_level=tta_level,
+                                max_batch_size=model_batch_size)
+
+        num_tiles = seam_blending.h_blocks * seam_blending.w_blocks
+        done = 0
+
+        def report(n):
+            nonlocal done
+            done += n
+            if progress is not None and progress(done, num_tiles):
+                raise RenderCancelled(f"tiled_render: cancelled at {done}/{num_tiles} tiles")
+
+        def update(z, output_indexes):
+            seam_blending.update_batch(z, output_indexes)
+            report(len(output_indexes))
+
+        report(0)
+
+        if replicas is not None:
+            outputs = replicas.imap(minibatches(indexes), device,
+                                    enable_amp=enable_amp, tta=tta, tta_level=tta_level,
+                                    max_batch_size=model_batch_size)
+        else:
+            outputs = ((forward(minibatch), output_indexes) for minibatch, output_indexes in minibatches(indexes))
+        for z, output_indexes in outputs:
+            update(z, output_indexes)
+
+        if uniform_tiles:
+            # one forward for each color
+            colors = list(uniform_tiles.values())
+            for k in range(0, len(colors), batch_size):
+                color_batch = torch.stack([color for color, _ in colors[k:k + batch_size]]).to(device)
+                minibatch = color_batch.view(-1, C, 1, 1).expand(-1, C, tile_size, tile_size)
+                z = forward(minibatch)
+                for n, (_, color_indexes) in enumerate(colors[k:k + batch_size]):
+                    # in chunks, because update_batch materializes the blended tiles
+                    for start in range(0, len(color_indexes), batch_size):
+                        chunk = color_indexes[start:start + batch_size]
+                        update(z[n:n + 1].expand(len(chunk), -1, -1, -1), chunk)
+        if masked_tiles:
+            output_size = tile_size * scale - offset * 2
+            for minibatch, output_indexes in minibatches(masked_tiles):
+                if fill_func is not None:
+                    z = fill_func(minibatch)
+                else:
+                    z = F.interpolate(minibatch, scale_factor=scale, mode="bilinear", align_corners=False)
+                update(z[:, :, offset:offset + output_size, offset:offset + output_size], output_indexes)
+
+        num_uniform = sum(len(color_indexes) for _, color_indexes in uniform_tiles.values())
+        if stats is not None:
+            stats["tiles"] = stats.get("tiles", 0) + num_tiles
+            stats["skipped_uniform"] = stats.get("skipped_uniform", 0) + num_uniform
+            stats["skipped_masked"] = stats.get("skipped_masked", 0) + len(masked_tiles)
+        if skip_uniform or render_mask is not None:
+            logger.debug(f"tiled_render: skipped {num_uniform + len(masked_tiles)}/{num_tiles} tiles "
+                         f"(uniform={num_uniform}, colors={len(uniform_tiles)}, "
+                         f"masked={len(masked_tiles)})")
 
         return seam_blending.get_output().contiguous()
 
+    @staticmethod
+    def find_skip_tiles(x, step, tile_size, uniform_tolerance=None, render_mask=None):
+        """
+        x: padded image, render_mask: padded render mask
+        returns ({color_key: (color, [(h_i, w_i), ...])}, [(h_i, w_i), ...] of masked tiles)
+        """
+        masked = None
+        if render_mask is not None:
+            masked = render_mask.unfold(1, tile_size, step).unfold(2, tile_size, step).amax(dim=(0, 3, 4)) == 0
+            masked_tiles = [tuple(index) for index in masked.nonzero().tolist()]
+        else:
+            masked_tiles = []
+
+        uniform_tiles = {}
+        if uniform_tolerance is not None:
+            tiles = x.unfold(1, tile_size, step).unfold(2, tile_size, step)  # C x h_blocks x w_blocks x T x T
+            tile_max = tiles.amax(dim=(3, 4))
+            tile_min = tiles.amin(dim=(3, 4))
+            uniform = ((tile_max - tile_min) <= uniform_tolerance).all(dim=0)
+            if masked is not None:
+                uniform = torch.logical_and(uniform, torch.logical_not(masked))
+            # (max + min) / 2 is exactly the color of a constant tile
+            colors = ((tile_max + tile_min) * 0.5).permute(1, 2, 0).cpu()
+            for h_i, w_i in uniform.nonzero().tolist():
+                color = colors[h_i, w_i]
+                key = tuple(torch.round(color * 255).long().tolist())
+                if key not in uniform_tiles:
+                    uniform_tiles[key] = (color, [])
+                uniform_tiles[key][1].append((h_i, w_i))
+
+        return uniform_tiles, masked_tiles
+
+    @staticmethod
+    def tiled_render_rows(x, model, tile_size=256, batch_size=4, enable_amp=True, tta=False, tta_level=8,
+                          progress=None):
+        """
+        Streaming version of tiled_render. Renders one row of tiles at a time and yields `(y, rows)`,
+        where `rows` is the output image from row `y` to the end of the rows that no later tile overlaps.
+        Memory usage is about one row of tiles plus the blend overlap, instead of the full output size.
+        x: CHW tensor or `RowStream`, e.g. the output rows of another `tiled_render_rows()`.
+        tta, tta_level, progress: same as `tiled_render()`.
+        """
+        assert not torch.is_grad_enabled()
+        C, H, W = x.shape
+        scale = get_model_config(model, "i2i_scale")
+        offset = get_model_config(model, "i2i_offset")
+        blend_size = get_model_config(model, "i2i_blend_size")
+        if blend_size is None:
+            blend_size = 0
+        device = get_model_device(model)
+        seam_blending = SeamBlending(x.shape, scale=scale,
+                                     offset=offset, tile_size=tile_size,
+                                     blend_size=blend_size, band=True, device=device)
+        seam_blending.eval()
+        step = seam_blending.input_tile_step
+        output_step = seam_blending.output_tile_step
+        pad_left, pad_right, pad_top, _ = seam_blending.pad
+        model_batch_size = batch_size
+        if tta:
+            batch_size = max(batch_size // tta_level, 1)
+        indexes = [(0, w_i) for w_i in range(seam_blending.w_blocks)]
+        num_tiles = seam_blending.h_blocks * seam_blending.w_blocks
+        if progress is not None and progress(0, num_tiles):
+            raise RenderCancelled(f"tiled_render_rows: cancelled at 0/{num_tiles} tiles")
+        for h_i in range(seam_blending.h_blocks):
+            # replicate padding for the top and bottom edges by clamping row indexes
+            i = h_i * step - pad_top
+            row_index = torch.arange(i, i + tile_size).clamp_(0, H - 1)
+            if isinstance(x, RowStream):
+                band = x.take_rows(row_index)
+            else:
+                band = x.index_select(1, row_index)
+            band = F.pad(band.to(device).unsqueeze(0), (pad_left, pad_right, 0, 0), mode='replicate')[0]
+            for minibatch, output_indexes in SeamBlending._device_minibatches(
+                    band, indexes, step, tile_size, batch_size):
+                z = tile_forward(model, minibatch, enable_amp=enable_amp, tta=tta, tta_level=tta_level,
+                                 max_batch_size=model_batch_size)
+                seam_blending.update_batch(z, output_indexes)
+            done = (h_i + 1) * seam_blending.w_blocks
+            if progress is not None and progress(done, num_tiles):
+                raise RenderCancelled(f"tiled_render_rows: cancelled at {done}/{num_tiles} tiles")
+
+            y = h_i * output_step
+            if h_i == seam_blending.h_blocks - 1:
+                rows = seam_blending.y_h - y
+            else:
+                rows = min(output_step, seam_blending.y_h - y)
+            if rows > 0:
+                yield y, seam_blending.get_band_output(rows)
+            seam_blending.advance()
+
+    @staticmethod
+    def can_pad_on_device(x, pad, device, max_usage=0.25):
+        device = torch.device(device)
+        if device.type == "cpu":
+            # No extra copy. Tiles are taken from the padded image that is required in any case.
+            return True
+        if device.type != "cuda":
+            return False
+        C, H, W = x.shape
+        padded_bytes = C * (H + pad[2] + pad[3]) * (W + pad[0] + pad[1]) * x.element_size()
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        # input + padded image, and leave the rest for activations
+        return (x.numel() * x.element_size() + padded_bytes) < free_bytes * max_usage
+
+    @staticmethod
+    def _minibatches(x, indexes, step, tile_size, batch_size, device):
+        minibatch = torch.zeros((batch_size, x.shape[0], tile_size, tile_size))
+        for k in range(0, len(indexes), batch_size):
+            output_indexes = indexes[k:k + batch_size]
+            for n, (h_i, w_i) in enumerate(output_indexes):
+                i, j = h_i * step, w_i * step
+                minibatch[n] = x[:, i:i + tile_size, j:j + tile_size]
+            yield minibatch[0:len(output_indexes)].to(device), output_indexes
+
+    @staticmethod
+    def _device_minibatches(x, indexes, step, tile_size, batch_size):
+        # x: padded image on the device. tiles are gathered from the unfold view with one indexing op.
+        tiles = x.unfold(1, tile_size, step).unfold(2, tile_size, step)  # C x h_blocks x w_blocks x T x T
+        for k in range(0, len(indexes), batch_size):
+            output_indexes = indexes[k:k + batch_size]
+            h_index = torch.tensor([h_i for h_i, _ in output_indexes], dtype=torch.long, device=x.device)
+            w_index = torch.tensor([w_i for _, w_i in output_indexes], dtype=torch.long, device=x.device)
+            yield tiles[:, h_index, w_index].permute(1, 0, 2, 3).contiguous(), output_indexes
+
+    @staticmethod
+    def _pipeline_minibatches(x, indexes, step, tile_size, batch_size, device):
+        # Minibatch N+1 is staged and uploaded while the model runs on minibatch N.
+        staging = TileStaging((batch_size, x.shape[0], tile_size, tile_size), device)
+        prefetch = None
+        for k in range(0, len(indexes), batch_size):
+            output_indexes = indexes[k:k + batch_size]
+            minibatch = staging.next_buffer()
+            for n, (h_i, w_i) in enumerate(output_indexes):
+                i, j = h_i * step, w_i * step
+                minibatch[n] = x[:, i:i + tile_size, j:j + tile_size]
+            upload = staging.upload(len(output_indexes)), output_indexes
+            if prefetch is not None:
+                yield staging.wait(prefetch[0]), prefetch[1]
+            prefetch = upload
+        if prefetch is not None:
+            yield staging.wait(prefetch[0]), prefetch[1]
+
     @staticmethod
     def create_config(x_size, scale, offset, tile_size, blend_size):
         x_h = x_size[0]
@@ -93,13 +708,11 @@ class SeamBlending(torch.nn.Module):
         input_blend_size = math.ceil(blend_size / scale)
 
         input_tile_step = tile_size - (input_offset * 2 + input_blend_size)
-        h_blocks = w_blocks = input_h = input_w = 0
-        while input_h < x_h + input_offset * 2:
-            input_h = h_blocks * input_tile_step + tile_size
-            h_blocks += 1
-        while input_w < x_w + input_offset * 2:
-            input_w = w_blocks * input_tile_step + tile_size
-            w_blocks += 1
+        # the smallest number of blocks that covers the padded input
+        h_blocks = max(math.ceil((x_h + input_offset * 2 - tile_size) / input_tile_step), 0) + 1
+        w_blocks = max(math.ceil((x_w + input_offset * 2 - tile_size) / input_tile_step), 0) + 1
+        input_h = (h_blocks - 1) * input_tile_step + tile_size
+        input_w = (w_blocks - 1) * input_tile_step + tile_size
 
         output_tile_step = input_tile_step * scale
         output_h = input_h * scale
@@ -124,30 +737,48 @@ class SeamBlending(torch.nn.Module):
     @staticmethod
     def create_blend_filter(scale, offset, tile_size, blend_size, out_channels):
         model_output_size = tile_size * scale - offset * 2
-        inner_tile_size = model_output_size - blend_size * 2
-        x = torch.ones((out_channels, inner_tile_size, inner_tile_size), dtype=torch.float32)
-        for i in range(blend_size):
-            value = 1 - (1 / (blend_size + 1)) * (i + 1)
-            x = F.pad(x, (1, 1, 1, 1), mode="constant", value=value)
-        return x
+        # value at the distance `d` from the tile border. The same values as padding the inner ones
+        # with `1 - (1 / (blend_size + 1)) * (i + 1)` for i = 0 .. blend_size - 1 from the inside
+        values = torch.tensor([1 - (1 / (blend_size + 1)) * (blend_size - d) for d in range(blend_size)] + [1.0],
+                              dtype=torch.float32)
+        index = torch.arange(model_output_size)
+        d = torch.minimum(index, model_output_size - 1 - index).clamp_(max=blend_size)
+        x = values[torch.minimum(d.view(-1, 1), d.view(1, -1))]
+        return x.unsqueeze(0).expand(out_channels, -1, -1).contiguous()
 
-    @staticmethod
-    def update(output_x, blend_filter, step_size, blend_size, pixels, weights, i, j):
-        C, H, W = output_x.shape
-        index = (slice(None, None),
-                 slice(step_size * i, step_size * i + H),
-                 slice(step_size * j, step_size * j + W))
-        if blend_size > 0:
-            assert blend_filter.shape == output_x.shape
-            old_weight = weights[index]
-            next_weight = old_weight + blend_filter
-            old_weight = old_weight / next_weight  # old_weight <= next_weight
-            new_weight = 1 - old_weight
-            pixels[index] = pixels[index] * old_weight + output_x * new_weight
-            weights[index] += blend_filter
-
-            return pixels[index]
-        else:
-            # No blending
-            pixels[index] = output_x
-            return output_x
+
+def _test_buffer_dtype():
+    # python -m nunif.utils.seam_blending
+    # 8-bit output of the half precision seam blending buffers against float32
+    import torch.nn as nn
+    from .. models import I2IBaseModel
+
+    class TestModel(I2IBaseModel):
+        name = "nunif.seam_blending_test_model"
+
+        def __init__(self):
+            super().__init__({}, scale=2, offset=8, in_channels=3, blend_size=4)
+            self.conv = nn.Sequential(
+                nn.Conv2d(3, 32, 3, 1, 0), nn.LeakyReLU(0.1),
+                nn.Conv2d(32, 12, 3, 1, 0), nn.PixelShuffle(2))
+
+        def forward(self, x):
+            # 8 px offset: 4 px for 2 convs at 2x, and 4 px cropped
+            return torch.sigmoid(self.conv(x)[:, :, 4:-4, 4:-4])
+
+    torch.manual_seed(71)
+    model = TestModel().eval()
+    x = torch.rand((3, 150, 211))
+    with torch.no_grad():
+        outputs = {dtype: SeamBlending.tiled_render(x, model, tile_size=64, buffer_dtype=dtype)
+                   for dtype in (torch.float32, torch.float16, torch.bfloat16)}
+    expected = torch.round(outputs[torch.float32] * 255)
+    for dtype in (torch.float16, torch.bfloat16):
+        diff = (torch.round(outputs[dtype] * 255) - expected).abs()
+        print(f"{dtype}: max diff={int(diff.max().item())} levels, "
+              f"changed pixels={round((diff > 0).float().mean().item() * 100, 3)}%")
+    assert (torch.round(outputs[torch.float16] * 255) - expected).abs().max().item() <= 1
+
+
+if __name__ == "__main__":
+    _test_buffer_dtype()
@@ -0,0 +1,204 @@
+# Tile sharding for tiled_render.
+# Tile minibatches of one image are spread across several model replicas,
+# each on its own device (DeviceReplicas) or in its own CPU worker process (ProcessReplicas).
+# `imap()` returns the outputs in the submission order, so the result of seam blending is
+# the same as the single model.
+import copy
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from .seam_blending import tile_forward
+from .. models import get_model_device
+from .. models.optimize import unwrap_optimized_model
+from .. models.utils import share_model_memory
+from .. logger import logger
+
+
+def _unwrap(model):
+    if isinstance(model, nn.DataParallel):
+        return model.module
+    return model
+
+
+class DeviceReplicas():
+    """ Model replicas on multiple devices.
+    Each replica is driven by its own thread. PyTorch releases the GIL during the forward pass,
+    so the devices run concurrently.
+    """
+    def __init__(self, model, devices):
+        model = _unwrap(model)
+        model_device = get_model_device(model)
+        self.devices = [torch.device(device) for device in devices]
+        # the original model is used as is for its own device.
+        # optimized modules cannot be copied, so the replicas on other devices are eager models
+        self.models = [model if device == model_device else
+                       copy.deepcopy(unwrap_optimized_model(model)).to(device).eval()
+                       for device in self.devices]
+        self.free_models = queue.Queue()
+        for model in self.models:
+            self.free_models.put(model)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.models))
+
+    def __len__(self):
+        return len(self.models)
+
+    def _forward(self, minibatch, output_device, forward_kwargs):
+        model = self.free_models.get()
+        try:
+            # grad mode is thread local
+            with torch.no_grad():
+                device = get_model_device(model)
+                z = tile_forward(model, minibatch.to(device), **forward_kwargs)
+                return z.to(output_device)
+        finally:
+            self.free_models.put(model)
+
+    def imap(self, minibatches, output_device, **forward_kwargs):
+        """ minibatches: iterable of (minibatch, indexes). yields (output, indexes) in order
+        """
+        pending = deque()
+        for minibatch, indexes in minibatches:
+            # minibatch buffers may be reused by the generator
+            pending.append((self.executor.submit(self._forward, minibatch.clone(), output_device, forward_kwargs),
+                            indexes))
+            if len(pending) >= len(self.models) * 2:
+                future, indexes = pending.popleft()
+                yield future.result(), indexes
+        while pending:
+            future, indexes = pending.popleft()
+            yield future.result(), indexes
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _process_worker(model, num_threads, task_queue, result_queue):
+    torch.set_num_threads(num_threads)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        call_id, seq, minibatch, forward_kwargs = task
+        try:
+            with torch.no_grad():
+                z = tile_forward(model, minibatch, **forward_kwargs)
+            result_queue.put((call_id, seq, z, None))
+        except Exception as e:
+            result_queue.put((call_id, seq, None, e))
+
+
+class ProcessReplicas():
+    """ Model replicas in CPU worker processes.
+    The weights are moved to shared memory once, so the workers do not copy them.
+    `num_threads` is the number of intra-op threads for each worker.
+    `imap()` can be called from multiple threads. The results are routed to each call by a dispatcher thread.
+    `timeout` is the interval in seconds to check that the workers are alive while waiting for the results.
+    """
+    def __init__(self, model, num_workers, num_threads=None, timeout=1.0):
+        assert num_workers > 0
+        if num_threads is None:
+            num_threads = max(torch.get_num_threads() // num_workers, 1)
+        # optimized modules cannot be sent to other processes
+        model = unwrap_optimized_model(model).to("cpu").eval()
+        share_model_memory(model)
+        context = mp.get_context("spawn")
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.workers = [context.Process(target=_process_worker,
+                                        args=(model, num_threads, self.task_queue, self.result_queue),
+                                        daemon=True)
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.call_id = 0
+        self.call_queues = {}
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+        logger.debug(f"ProcessReplicas: num_workers={num_workers}, num_threads={num_threads}")
+
+    def __len__(self):
+        return len(self.workers)
+
+    def _dispatch(self):
+        while True:
+            result = self.result_queue.get()
+            if result is None:
+                break
+            call_id, seq, z, e = result
+            with self.lock:
+                call_queue = self.call_queues.get(call_id)
+            # results of an abandoned call are discarded
+            if call_queue is not None:
+                call_queue.put((seq, z, e))
+
+    def _receive(self, call_queue):
+        while True:
+            try:
+                return call_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                # a dead worker never returns the result of its task
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("ProcessReplicas: a worker process exited unexpectedly")
+
+    def imap(self, minibatches, output_device, **forward_kwargs):
+        """ minibatches: iterable of (minibatch, indexes). yields (output, indexes) in order
+        """
+        call_queue = queue.Queue()
+        with self.lock:
+            self.call_id += 1
+            call_id = self.call_id
+            self.call_queues[call_id] = call_queue
+        pending = {}
+        results = {}
+        next_seq = 0
+
+        def pop():
+            nonlocal next_seq
+            while next_seq not in results:
+                seq, z, e = self._receive(call_queue)
+                if e is not None:
+                    raise e
+                results[seq] = z
+            z = results.pop(next_seq)
+            indexes = pending.pop(next_seq)
+            next_seq += 1
+            return z.to(output_device), indexes
+
+        try:
+            for seq, (minibatch, indexes) in enumerate(minibatches):
+                # minibatch buffers may be reused by the generator
+                self.task_queue.put((call_id, seq, minibatch.to("cpu", copy=True), forward_kwargs))
+                pending[seq] = indexes
+                if len(pending) >= len(self.workers) * 2:
+                    yield pop()
+            while pending:
+                yield pop()
+        finally:
+            with self.lock:
+                self.call_queues.pop(call_id, None)
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.result_queue.put(None)
+        self.dispatcher.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -9,6 +9,7 @@ from nunif.transforms import functional as NF
 import nunif.transforms.image_magick as IM
 from nunif.logger import logger
 from nunif.utils.image_loader import ImageLoader
+from nunif.utils.render import TILE_ORDERS
 from tqdm import tqdm
 import time
 
@@ -97,8 +98,9 @@ def psnr256(x1, x2, color):
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model-dir", type=str, required=True,
-                        help="model dir")
+    parser.add_argument("--model-dir", type=str, nargs="+", required=True,
+                        help=("model dir. when multiple dirs are specified, e.g. fp32 and int8 models, "
+                              "PSNR diff and speedup are reported against the first dir"))
     parser.add_argument("--noise-level", "-n", type=int, default=0, choices=[0, 1, 2, 3],
                         help="noise level")
     parser.add_argument("--method", "-m", type=str,
@@ -141,6 +143,12 @@ def parse_args():
                         help="input directory. (*.txt, *.csv) for image list")
     parser.add_argument("--tta", action="store_true",
                         help="TTA mode (aka geometric self-ensemble)")
+    parser.add_argument("--tta-level", type=int, nargs="+", choices=[1, 2, 4, 8],
+                        help=("number of TTA variants. 1 for no TTA. "
+                              "when multiple levels are specified, PSNR and time are reported for each level"))
+    parser.add_argument("--tile-order", type=str, nargs="+", choices=TILE_ORDERS, default=["row"],
+                        help=("traversal order of tiles. "
+                              "when multiple orders are specified, PSNR and time are reported for each order"))
     parser.add_argument("--disable-amp", action="store_true",
                         help="disable AMP for some special reason")
     args = parser.parse_args()
@@ -153,10 +161,11 @@ def main():
     from .utils import Waifu2x
 
     args = parse_args()
-    ctx = Waifu2x(model_dir=args.model_dir, gpus=args.gpu)
     model_method = args.model_method if args.model_method is not None else args.method
-
-    ctx.load_model(model_method, args.noise_level)
+    ctxs = {}
+    for model_dir in args.model_dir:
+        ctxs[model_dir] = Waifu2x(model_dir=model_dir, gpus=args.gpu)
+        ctxs[model_dir].load_model(model_method, args.noise_level)
 
     if path.isdir(args.input):
         files = ImageLoader.listdir(args.input)
@@ -168,8 +177,16 @@ def main():
     loader = ImageLoader(files=files, max_queue_size=128, load_func_kwargs={"color": "rgb"})
     if args.output is not None:
         os.makedirs(args.output, exist_ok=True)
+    if args.tta_level is not None:
+        tta_levels = args.tta_level
+    else:
+        tta_levels = [8] if args.tta else [1]
+    configs = [(model_dir, level, order)
+               for model_dir in args.model_dir for level in tta_levels for order in args.tile_order]
     with torch.no_grad():
-        mse_sum = psnr_sum = time_sum = 0
+        mse_sum = {config: 0 for config in configs}
+        psnr_sum = {config: 0 for config in configs}
+        time_sum = {config: 0 for config in configs}
         baseline_mse_sum = baseline_psnr_sum = baseline_time_sum = 0
         count = 0
 
@@ -177,18 +194,22 @@ def main():
             x = TF.to_tensor(im)
             groundtruth = NF.crop_mod(x, 4)
             x, groundtruth = make_input_waifu2x(groundtruth, args)
-            t = time.time()
-            z, _ = ctx.convert(x, None, model_method, args.noise_level,
-                               args.tile_size, args.batch_size,
-                               tta=args.tta, enable_amp=not args.disable_amp)
-            time_sum += time.time() - t
-            if args.border > 0:
-                psnr, mse = psnr256(remove_border(groundtruth, args.border),
-                                    remove_border(z, args.border), args.color)
-            else:
-                psnr, mse = psnr256(groundtruth, z, args.color)
-            psnr_sum += psnr
-            mse_sum += mse
+            for config in configs:
+                model_dir, level, order = config
+                ctx = ctxs[model_dir]
+                t = time.time()
+                z, _ = ctx.convert(x, None, model_method, args.noise_level,
+                                   args.tile_size, args.batch_size,
+                                   tta=level > 1, tta_level=max(level, 2),
+                                   enable_amp=not args.disable_amp, tile_order=order)
+                time_sum[config] += time.time() - t
+                if args.border > 0:
+                    psnr, mse = psnr256(remove_border(groundtruth, args.border),
+                                        remove_border(z, args.border), args.color)
+                else:
+                    psnr, mse = psnr256(groundtruth, z, args.color)
+                psnr_sum[config] += psnr
+                mse_sum[config] += mse
 
             if args.baseline:
                 t = time.time()
@@ -208,11 +229,27 @@ def main():
                 baseline_mse_sum += mse
             count += 1
 
-        mpsnr = round(psnr_sum / count, 4)
-        rmse = round(math.sqrt(mse_sum / count), 4)
-        fps = round(count / time_sum, 4)
-        print(f"* {args.model_dir}")
-        print(f"PSNR: {mpsnr}, RMSE: {rmse}, time: {round(time_sum, 4)} ({fps} FPS)")
+        for model_dir in args.model_dir:
+            print(f"* {model_dir}")
+            for config in configs:
+                if config[0] != model_dir:
+                    continue
+                _, level, order = config
+                mpsnr = round(psnr_sum[config] / count, 4)
+                rmse = round(math.sqrt(mse_sum[config] / count), 4)
+                fps = round(count / time_sum[config], 4)
+                prefix = f"tta_level={level}, " if tta_levels != [1] else ""
+                if args.tile_order != ["row"]:
+                    prefix += f"tile_order={order}, "
+                # the first model dir is the reference, e.g. fp32 models for int8 models
+                reference = (args.model_dir[0], level, order)
+                if model_dir != args.model_dir[0]:
+                    psnr_diff = round((psnr_sum[config] - psnr_sum[reference]) / count, 4)
+                    speedup = round(time_sum[reference] / time_sum[config], 2)
+                    suffix = f", PSNR diff: {psnr_diff}, speedup: {speedup}x"
+                else:
+                    suffix = ""
+                print(f"{prefix}PSNR: {mpsnr}, RMSE: {rmse}, time: {round(time_sum[config], 4)} ({fps} FPS){suffix}")
         if args.baseline:
             mpsnr = round(baseline_psnr_sum / count, 4)
             rmse = round(math.sqrt(baseline_mse_sum / count), 4)
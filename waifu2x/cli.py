@@ -10,7 +10,7 @@ from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 from nunif.logger import logger
 from nunif.utils.image_loader import ImageLoader
 from nunif.utils.filename import set_image_ext
-from .utils import Waifu2x
+from .utils import Waifu2x, DEFAULT_AUTOTUNE_CACHE_FILE, OPTIMIZE_METHODS
 
 
 DEFAULT_MODEL_DIR = path.abspath(path.join(
@@ -18,19 +18,40 @@ DEFAULT_MODEL_DIR = path.abspath(path.join(
     "swin_unet", "art"))
 
 
+def log_skip_stats(stats):
+    if stats.get("tiles"):
+        skipped = stats["skipped_uniform"] + stats["skipped_masked"]
+        logger.info(f"skipped tiles: {skipped}/{stats['tiles']} "
+                    f"(uniform={stats['skipped_uniform']}, transparent={stats['skipped_masked']})")
+
+
+def check_roi(roi, x, filename):
+    # the same --roi is used for all images of the directory/list input
+    if roi is None:
+        return
+    top, left, height, width = roi
+    H, W = x.shape[1:]
+    if not (0 <= top and 0 <= left and 0 < height and 0 < width and top + height <= H and left + width <= W):
+        raise ValueError(f"{filename}: --roi {top} {left} {height} {width} is out of the image size {W}x{H}")
+
+
 def convert_files(ctx, files, args, enable_amp):
     loader = ImageLoader(files=files, max_queue_size=128,
                          load_func=IL.load_image,
                          load_func_kwargs={"color": "rgb", "keep_alpha": True})
     os.makedirs(args.output, exist_ok=True)
     futures = []
+    stats = {}
     with torch.no_grad(), PoolExecutor(max_workers=cpu_count() // 2 or 1) as pool:
         for im, meta in tqdm(loader, ncols=60):
             rgb, alpha = IL.to_tensor(im, return_alpha=True)
+            check_roi(args.roi, rgb, meta["filename"])
             rgb, alpha = ctx.convert(
                 rgb, alpha, args.method, args.noise_level,
                 args.tile_size, args.batch_size,
-                args.tta, enable_amp=enable_amp)
+                args.tta, enable_amp=enable_amp,
+                skip_uniform=args.skip_uniform_tiles, stats=stats,
+                fast_alpha=not args.disable_fast_alpha, tta_level=args.tta_level, roi=args.roi)
             output_filename = set_image_ext(path.basename(meta["filename"]), format=args.format)
             if args.depth is not None:
                 meta["depth"] = args.depth
@@ -43,6 +64,8 @@ def convert_files(ctx, files, args, enable_amp):
                 format=args.format))
         for f in futures:
             f.result()
+    if args.skip_uniform_tiles:
+        log_skip_stats(stats)
 
 
 def convert_file(ctx, args, enable_amp):
@@ -54,9 +77,23 @@ def convert_file(ctx, args, enable_amp):
     with torch.no_grad():
         im, meta = IL.load_image(args.input, color="rgb", keep_alpha=True)
         rgb, alpha = IL.to_tensor(im, return_alpha=True)
-        rgb, alpha = ctx.convert(rgb, alpha, args.method, args.noise_level,
-                                 args.tile_size, args.batch_size,
-                                 args.tta, enable_amp=enable_amp)
+        check_roi(args.roi, rgb, args.input)
+        stats = {}
+        with tqdm(ncols=60, unit="tile") as pbar:
+            def progress(done, total):
+                # reset for each pass (RGB and alpha channel)
+                if total != pbar.total or done < pbar.n:
+                    pbar.reset(total=total)
+                pbar.update(done - pbar.n)
+
+            rgb, alpha = ctx.convert(rgb, alpha, args.method, args.noise_level,
+                                     args.tile_size, args.batch_size,
+                                     args.tta, enable_amp=enable_amp,
+                                     skip_uniform=args.skip_uniform_tiles, stats=stats,
+                                     fast_alpha=not args.disable_fast_alpha, tta_level=args.tta_level,
+                                     progress=progress, roi=args.roi)
+        if args.skip_uniform_tiles:
+            log_skip_stats(stats)
         if args.depth is not None:
             meta["depth"] = args.depth
         depth = meta["depth"] if "depth" in meta and meta["depth"] is not None else 8
@@ -75,16 +112,26 @@ def load_files(txt):
 
 
 def main(args):
-    ctx = Waifu2x(model_dir=args.model_dir, gpus=args.gpu)
-    ctx.load_model(args.method, args.noise_level)
-
-    if path.isdir(args.input):
-        convert_files(ctx, ImageLoader.listdir(args.input), args, enable_amp=not args.disable_amp)
-    else:
-        if path.splitext(args.input)[-1] in (".txt", ".csv"):
-            convert_files(ctx, load_files(args.input), args, enable_amp=not args.disable_amp)
+    ctx = Waifu2x(model_dir=args.model_dir, gpus=args.gpu, cpu_workers=args.cpu_workers)
+    if args.autotune:
+        ctx.load_model(args.method, args.noise_level)
+        args.tile_size, args.batch_size = ctx.autotune(
+            args.method, args.noise_level,
+            enable_amp=not args.disable_amp, cache_file=args.autotune_cache)
+    # models are optimized for the final tile size
+    ctx.load_model(args.method, args.noise_level, optimize=args.optimize,
+                   tile_size=args.tile_size, batch_size=args.batch_size, enable_amp=not args.disable_amp)
+
+    try:
+        if path.isdir(args.input):
+            convert_files(ctx, ImageLoader.listdir(args.input), args, enable_amp=not args.disable_amp)
         else:
-            convert_file(ctx, args, enable_amp=not args.disable_amp)
+            if path.splitext(args.input)[-1] in (".txt", ".csv"):
+                convert_files(ctx, load_files(args.input), args, enable_amp=not args.disable_amp)
+            else:
+                convert_file(ctx, args, enable_amp=not args.disable_amp)
+    finally:
+        ctx.close()
 
 
 if __name__ == "__main__":
@@ -94,13 +141,33 @@ if __name__ == "__main__":
     parser.add_argument("--method", "-m", type=str,
                         choices=["scale4x", "scale", "noise", "noise_scale", "noise_scale4x", "scale2x", "noise_scale2x"],
                         default="noise_scale", help="method")
-    parser.add_argument("--gpu", "-g", type=int, nargs="+", default=[0], help="GPU device ids. -1 for CPU")
+    parser.add_argument("--gpu", "-g", type=int, nargs="+", default=[0],
+                        help="GPU device ids. -1 for CPU. the tiles are sharded across multiple GPUs")
+    parser.add_argument("--cpu-workers", type=int, default=0,
+                        help="number of worker processes to shard the tiles on CPU (with -g -1)")
     parser.add_argument("--batch-size", type=int, default=4, help="minibatch_size")
     parser.add_argument("--tile-size", type=int, default=256, help="tile size for tiled render")
+    parser.add_argument("--optimize", type=str, default="none", choices=OPTIMIZE_METHODS,
+                        help=("optimize the models with TorchScript (script), torch.compile (compile) "
+                              "or channels_last and fused Conv2d+LeakyReLU (fuse). "
+                              "falls back to the eager model when it fails"))
+    parser.add_argument("--autotune", action="store_true",
+                        help="benchmark and use the best --tile-size and --batch-size for the model and device")
+    parser.add_argument("--autotune-cache", type=str, default=DEFAULT_AUTOTUNE_CACHE_FILE,
+                        help="cache file for --autotune results")
     parser.add_argument("--output", "-o", type=str, required=True, help="output file or directory")
     parser.add_argument("--input", "-i", type=str, required=True, help="input file or directory. (*.txt, *.csv) for image list")
     parser.add_argument("--tta", action="store_true", help="use TTA mode")
+    parser.add_argument("--roi", type=int, nargs=4, metavar=("TOP", "LEFT", "HEIGHT", "WIDTH"),
+                        help=("convert only this region of the input image. "
+                              "the same region is used for all images of a directory/list input"))
+    parser.add_argument("--tta-level", type=int, default=8, choices=[2, 4, 8],
+                        help="number of TTA variants. 2: hflip, 4: hflip+vflip, 8: hflip+vflip+transpose")
+    parser.add_argument("--skip-uniform-tiles", action="store_true",
+                        help="skip the model for single-color tiles and fully transparent tiles")
     parser.add_argument("--disable-amp", action="store_true", help="disable AMP for some special reason")
+    parser.add_argument("--disable-fast-alpha", action="store_true",
+                        help="upscale binary alpha channel with the model instead of the edge-aware resize")
     parser.add_argument("--image-lib", type=str, choices=["pil", "wand"], default="pil",
                         help="image library to encode/decode images")
     parser.add_argument("--depth", type=int, help="bit-depth of output image. enabled only with `--image-lib wand`")
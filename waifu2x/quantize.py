@@ -0,0 +1,119 @@
+# int8 quantization of waifu2x models for CPU inference
+# python3 -m waifu2x.quantize -i ./waifu2x/pretrained_models/swin_unet/art -o ./int8_models/swin_unet/art -c ./calib_images
+# The output directory can be used as `--model-dir` of waifu2x.cli with `--gpu -1`.
+import os
+from os import path
+import random
+import argparse
+import torch
+from torchvision.transforms import functional as TF
+from nunif.models import load_model, save_model, get_model_config
+from nunif.models.quantize import quantize_model, QUANTIZED_ENGINES
+from nunif.models.utils import SAFETENSORS_EXT
+from nunif.utils.image_loader import ImageLoader
+from nunif.utils.autotune import TILE_SIZES, is_valid_tile_size
+from nunif.logger import logger
+
+
+def list_model_files(model_dir):
+    """ returns {name: model_path}. `.safetensors` is used when both `.pth` and `.safetensors` exist
+    """
+    files = {}
+    for filename in sorted(os.listdir(model_dir)):
+        name, ext = path.splitext(filename)
+        if ext.lower() == SAFETENSORS_EXT or (ext.lower() == ".pth" and name not in files):
+            files[name] = path.join(model_dir, filename)
+    return files
+
+
+def load_calibration_images(calib_dir, num_images, seed):
+    files = ImageLoader.listdir(calib_dir)
+    random.Random(seed).shuffle(files)
+    images = []
+    for im, meta in ImageLoader(files=files[:num_images], load_func_kwargs={"color": "rgb"}):
+        images.append(TF.to_tensor(im))
+    if not images:
+        raise ValueError(f"no images in {calib_dir}")
+    return images
+
+
+def make_calibration_data(images, model, crop_size, num_samples, batch_size, seed):
+    """ random crops of the images. yields BCHW minibatches
+    """
+    crop_size = next((size for size in TILE_SIZES
+                      if size >= crop_size and is_valid_tile_size(model, size)), None)
+    if crop_size is None:
+        raise ValueError(f"{model.name}: no valid calibration crop size")
+    in_channels = get_model_config(model, "i2i_in_channels") or 3
+    rng = random.Random(seed)
+    crops = []
+    for i in range(num_samples):
+        x = images[i % len(images)][:in_channels]
+        if x.shape[1] < crop_size or x.shape[2] < crop_size:
+            x = TF.resize(x, crop_size, antialias=True)
+        top = rng.randint(0, x.shape[1] - crop_size)
+        left = rng.randint(0, x.shape[2] - crop_size)
+        crops.append(x[:, top:top + crop_size, left:left + crop_size])
+        if len(crops) == batch_size:
+            yield torch.stack(crops)
+            crops = []
+    if crops:
+        yield torch.stack(crops)
+
+
+def quantize_file(input_path, output_path, images, args):
+    model, data = load_model(input_path)
+    model = model.eval()
+    modes = ["static", "dynamic"] if args.mode == "auto" else [args.mode]
+    for mode in modes:
+        try:
+            calibration_data = None
+            if mode == "static":
+                calibration_data = make_calibration_data(images, model, args.crop_size,
+                                                         args.num_samples, args.batch_size, args.seed)
+            qmodel = quantize_model(model, mode, calibration_data, engine=args.engine)
+            break
+        except Exception as e:
+            # e.g. swin_unet can not be traced with torch.fx, so only the dynamic mode is available
+            if mode == modes[-1]:
+                raise
+            logger.info(f"{model.name}: {mode} quantization failed, try the next mode: {repr(e)}")
+
+    save_model(qmodel, output_path, updated_at=data.get("updated_at"))
+    logger.info(f"{input_path} -> {output_path} ({model.name}, {qmodel.mode}, {qmodel.engine})")
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--input-dir", "-i", type=str, required=True, help="input model dir")
+    parser.add_argument("--output-dir", "-o", type=str, required=True, help="output int8 model dir")
+    parser.add_argument("--calib-dir", "-c", type=str, help="image dir for the calibration of the static mode")
+    parser.add_argument("--mode", type=str, choices=["auto", "static", "dynamic"], default="auto",
+                        help=("static: int8 Conv/Linear with the activation scales calibrated on the images. "
+                              "dynamic: int8 Linear only (swin_unet). "
+                              "auto: static if possible, otherwise dynamic"))
+    parser.add_argument("--engine", type=str, choices=QUANTIZED_ENGINES,
+                        help=("quantized engine. qnnpack for ARM. "
+                              "the model can only be loaded where the engine is supported. "
+                              "default: the first supported one of x86, fbgemm and qnnpack"))
+    parser.add_argument("--num-images", type=int, default=64, help="number of images used for calibration")
+    parser.add_argument("--num-samples", type=int, default=128, help="number of random crops for calibration")
+    parser.add_argument("--crop-size", type=int, default=112, help="size of the random crops")
+    parser.add_argument("--batch-size", type=int, default=8, help="minibatch size for calibration")
+    parser.add_argument("--seed", type=int, default=71, help="random seed")
+    args = parser.parse_args()
+    logger.debug(vars(args))
+
+    if args.mode != "dynamic" and args.calib_dir is None:
+        parser.error("--calib-dir is required for --mode static/auto")
+
+    images = load_calibration_images(args.calib_dir, args.num_images, args.seed) if args.calib_dir else None
+    os.makedirs(args.output_dir, exist_ok=True)
+    with torch.no_grad():
+        for name, input_path in list_model_files(args.input_dir).items():
+            # int8 weights are not plain tensors, so they are always saved as .pth
+            quantize_file(input_path, path.join(args.output_dir, name + ".pth"), images, args)
+
+
+if __name__ == "__main__":
+    main()
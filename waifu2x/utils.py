@@ -1,15 +1,113 @@
+import math
 from os import path
+import threading
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
 import torch
 import torch.nn.functional as F
-from nunif.transforms.tta import tta_merge, tta_split
-from nunif.utils.render import tiled_render
-from nunif.utils.alpha import AlphaBorderPadding
-from nunif.models import load_model, get_model_config
+from nunif.utils.render import tiled_render, tiled_render_cascade
+from nunif.utils.tile_sharding import DeviceReplicas, ProcessReplicas
+from nunif.utils.alpha import AlphaBorderPadding, upscale_binary_alpha
+from nunif.utils.autotune import autotune, DEFAULT_CACHE_FILE as DEFAULT_AUTOTUNE_CACHE_FILE
+from nunif.models import load_model, get_model_config, QuantizedI2IModel
+from nunif.models.utils import SAFETENSORS_EXT, share_model_memory
+from nunif.models.optimize import optimize_model, script_constant_bytes, OPTIMIZE_METHODS
 from nunif.logger import logger
 
 
+def model_memory_bytes(model):
+    tensors = itertools.chain(model.parameters(), model.buffers())
+    # optimized models also hold the copy of the weights in the frozen TorchScript module
+    return sum(t.numel() * t.element_size() for t in tensors) + script_constant_bytes(model)
+
+
+class _RegistryEntry():
+    def __init__(self, on_evict):
+        self.model = None
+        self.size = 0
+        self.users = 0
+        self.on_evict = on_evict
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry():
+    """
+    Thread-safe registry of models loaded on demand.
+    A model is loaded on first use, and the least recently used models are evicted
+    when the total size of the loaded models exceeds `max_bytes`.
+    Models in use are not evicted, so the total size can exceed `max_bytes` temporarily.
+    A registry can be shared by multiple Waifu2x instances (e.g. art and photo) to share the budget.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def _evict(self):
+        # self.lock must be held
+        for key, entry in list(self.entries.items()):
+            if entry.users == 0 and entry.model is None:
+                # failed to load
+                self.entries.pop(key)
+        if self.max_bytes is None:
+            return
+        total = sum(entry.size for entry in self.entries.values())
+        for key, entry in list(self.entries.items()):
+            if total <= self.max_bytes:
+                break
+            if entry.users > 0:
+                continue
+            self.entries.pop(key)
+            total -= entry.size
+            logger.debug(f"ModelRegistry: evict {key}")
+            if entry.on_evict is not None:
+                entry.on_evict(entry.model)
+
+    @contextmanager
+    def use(self, key, load_func, on_evict=None):
+        """ with registry.use(key, load_func) as model: ...
+        load_func: called to load the model when it is not loaded
+        on_evict: called with the model when it is evicted
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = _RegistryEntry(on_evict)
+            self.entries.move_to_end(key)
+            entry.users += 1
+        try:
+            # other models can be used while this one is loading
+            with entry.load_lock:
+                if entry.model is None:
+                    entry.model = load_func()
+                    entry.size = model_memory_bytes(entry.model)
+                    logger.debug(f"ModelRegistry: load {key}, {entry.size // (1024 * 1024)}MB")
+            with self.lock:
+                self._evict()
+            yield entry.model
+        finally:
+            with self.lock:
+                entry.users -= 1
+                self._evict()
+
+    def clear(self):
+        with self.lock:
+            for entry in self.entries.values():
+                if entry.model is not None and entry.on_evict is not None:
+                    entry.on_evict(entry.model)
+            self.entries.clear()
+
+
 class Waifu2x():
-    def __init__(self, model_dir, gpus):
+    def __init__(self, model_dir, gpus, cpu_workers=0, registry=None):
+        """
+        gpus: GPU device ids. -1 for CPU.
+              When multiple GPUs are specified, the tiles of an image are sharded across the model replicas.
+        cpu_workers: number of worker processes for tile sharding on CPU. 0 or 1 to disable.
+        registry: `ModelRegistry` to load the models on first use.
+                  When it is None, the models are loaded with `load_model()` or `load_model_all()`.
+        """
         self.scale_model = None
         self.scale4x_model = None
         self.noise_models = [None] * 4
@@ -20,10 +118,20 @@ class Waifu2x():
         else:
             self.device = f'cuda:{gpus[0]}'
         self.gpus = gpus
+        # models are loaded on the first device. other devices are used by tile sharding, not DataParallel
+        self.device_ids = gpus[:1]
+        self.cpu_workers = cpu_workers
+        self.replicas = {}
+        self.replicas_lock = threading.Lock()
+        self.registry = registry
+        self.optimize = "none"
+        self.optimize_kwargs = {}
         self.model_dir = model_dir
         self.alpha_pad = AlphaBorderPadding()
 
     def _setup(self):
+        # replicas are created again for the new models
+        self.close()
         if self.scale_model is not None:
             self.scale_model = self.scale_model.to(self.device)
             self.scale_model.eval()
@@ -44,119 +152,274 @@ class Waifu2x():
                 self.noise_scale4x_models[i] = self.noise_scale4x_models[i].to(self.device)
                 self.noise_scale4x_models[i].eval()
 
-    def load_model(self, method, noise_level):
+    def _model_path(self, name):
+        """ returns `{name}.safetensors` if it exists, otherwise `{name}.pth`
+        """
+        model_path = path.join(self.model_dir, name + SAFETENSORS_EXT)
+        if path.exists(model_path):
+            return model_path
+        return path.join(self.model_dir, name + ".pth")
+
+    def _load_model(self, model_path):
+        model, _ = load_model(model_path, map_location=self.device, device_ids=self.device_ids)
+        if isinstance(model, QuantizedI2IModel) and self.device != "cpu":
+            raise ValueError(f"{model_path}: int8 quantized models are CPU only. Use `--gpu -1`")
+        model = model.to(self.device).eval()
+        if self.optimize != "none":
+            model = optimize_model(model, self.optimize, model_file=model_path, **self.optimize_kwargs)
+        return model
+
+    def set_optimize(self, optimize, tile_size=256, batch_size=4, enable_amp=False):
+        """ optimize method for the models loaded after this. See `load_model()`
+        """
+        assert (optimize in OPTIMIZE_METHODS)
+        self.optimize = optimize
+        self.optimize_kwargs = {"tile_size": tile_size, "batch_size": batch_size, "enable_amp": enable_amp}
+
+    def load_model(self, method, noise_level, optimize="none", tile_size=256, batch_size=4, enable_amp=False):
+        """
+        optimize: none, script (TorchScript), compile (torch.compile) or fuse (channels_last and fused Conv2d+LeakyReLU).
+                  Each model is optimized once and warmed up with the minibatch of (batch_size, tile_size).
+                  When the optimization fails, the eager model is used.
+        """
         assert (method in ("scale", "noise_scale", "noise", "scale4x", "noise_scale4x"))
         assert (method in {"scale", "scale4x"} or 0 <= noise_level and noise_level < 4)
+        self.set_optimize(optimize, tile_size, batch_size, enable_amp)
 
-        scale2x_path = path.join(self.model_dir, "scale2x.pth")
-        scale4x_path = path.join(self.model_dir, "scale4x.pth")
+        scale2x_path = self._model_path("scale2x")
+        scale4x_path = self._model_path("scale4x")
         if method == "scale":
-            self.scale_model, _ = load_model(
-                scale2x_path,
-                map_location=self.device, device_ids=self.gpus)
+            self.scale_model = self._load_model(scale2x_path)
+        elif method == "scale4x" and self._is_cascade_4x(method, noise_level):
+            logger.info(f"`{scale4x_path}` does not exist. Use `{scale2x_path}` twice for 4x")
+            self.scale_model = self._load_model(scale2x_path)
         elif method == "scale4x":
-            self.scale4x_model, _ = load_model(
-                scale4x_path,
-                map_location=self.device, device_ids=self.gpus)
+            self.scale4x_model = self._load_model(scale4x_path)
         elif method == "noise":
-            self.noise_models[noise_level], _ = load_model(
-                path.join(self.model_dir, f"noise{noise_level}.pth"),
-                map_location=self.device, device_ids=self.gpus)
+            self.noise_models[noise_level] = self._load_model(
+                self._model_path(f"noise{noise_level}"))
         elif method == "noise_scale":
-            self.noise_scale_models[noise_level], _ = load_model(
-                path.join(self.model_dir, f"noise{noise_level}_scale2x.pth"),
-                map_location=self.device, device_ids=self.gpus)
+            self.noise_scale_models[noise_level] = self._load_model(
+                self._model_path(f"noise{noise_level}_scale2x"))
             # for alpha channel
             if path.exists(scale2x_path):
-                self.scale_model, _ = load_model(
-                    scale2x_path,
-                    map_location=self.device, device_ids=self.gpus)
+                self.scale_model = self._load_model(scale2x_path)
             else:
                 logger.warning(f"`{scale2x_path}` used for alpha channel does not exist. "
                                "So use BILINEAR for upscaling alpha channel.")
+        elif method == "noise_scale4x" and self._is_cascade_4x(method, noise_level):
+            noise_scale2x_path = self._model_path(f"noise{noise_level}_scale2x")
+            logger.info(f"`{self._model_file(method, noise_level)}` does not exist. "
+                        f"Use `{noise_scale2x_path}` and `{scale2x_path}` for 4x")
+            self.noise_scale_models[noise_level] = self._load_model(noise_scale2x_path)
+            # for the second pass and alpha channel
+            self.scale_model = self._load_model(scale2x_path)
         elif method == "noise_scale4x":
-            self.noise_scale4x_models[noise_level], _ = load_model(
-                path.join(self.model_dir, f"noise{noise_level}_scale4x.pth"),
-                map_location=self.device, device_ids=self.gpus)
+            self.noise_scale4x_models[noise_level] = self._load_model(
+                self._model_path(f"noise{noise_level}_scale4x"))
             # for alpha channel
             if path.exists(scale4x_path):
-                self.scale4x_model, _ = load_model(
-                    scale4x_path,
-                    map_location=self.device, device_ids=self.gpus)
+                self.scale4x_model = self._load_model(scale4x_path)
             else:
                 logger.warning(f"`{scale4x_path}` used for alpha channel does not exist. "
                                "So use BILINEAR for upscaling alpha channel.")
         self._setup()
 
-    def load_model_all(self, load_4x=True):
-        self.scale_model = load_model(
-            path.join(self.model_dir, "scale2x.pth"),
-            map_location=self.device, device_ids=self.gpus)[0]
+    def load_model_all(self, load_4x=True, optimize="none", tile_size=256, batch_size=4, enable_amp=False):
+        self.set_optimize(optimize, tile_size, batch_size, enable_amp)
+        self.scale_model = self._load_model(self._model_path("scale2x"))
         self.noise_scale_models = [
-            load_model(
-                path.join(self.model_dir, f"noise{noise_level}_scale2x.pth"),
-                map_location=self.device, device_ids=self.gpus)[0]
+            self._load_model(self._model_path(f"noise{noise_level}_scale2x"))
             for noise_level in range(4)]
         self.noise_models = [
-            load_model(
-                path.join(self.model_dir, f"noise{noise_level}.pth"),
-                map_location=self.device, device_ids=self.gpus)[0]
+            self._load_model(self._model_path(f"noise{noise_level}"))
             for noise_level in range(4)]
 
         if load_4x:
-            if path.exists(path.join(self.model_dir, "scale4x.pth")):
-                self.scale4x_model = load_model(
-                    path.join(self.model_dir, "scale4x.pth"),
-                    map_location=self.device, device_ids=self.gpus)[0]
+            if path.exists(self._model_path("scale4x")):
+                self.scale4x_model = self._load_model(self._model_path("scale4x"))
                 self.noise_scale4x_models = [
-                    load_model(
-                        path.join(self.model_dir, f"noise{noise_level}_scale4x.pth"),
-                        map_location=self.device, device_ids=self.gpus)[0]
-                    if path.exists(path.join(self.model_dir, f"noise{noise_level}_scale4x.pth")) else None
+                    self._load_model(self._model_path(f"noise{noise_level}_scale4x"))
+                    if path.exists(self._model_path(f"noise{noise_level}_scale4x")) else None
                     for noise_level in range(4)]
 
         self._setup()
 
-    def render(self, x, method, noise_level, tile_size=256, batch_size=4, enable_amp=False):
-        assert (method in ("scale", "noise_scale", "noise", "scale4x", "noise_scale4x"))
-        assert (method in {"scale", "scale4x"} or 0 <= noise_level and noise_level < 4)
+    def _get_model(self, method, noise_level):
         if method == "scale":
-            z = tiled_render(x, self.scale_model,
-                             tile_size=tile_size, batch_size=batch_size,
-                             enable_amp=enable_amp)
+            return self.scale_model
         elif method == "scale4x":
-            z = tiled_render(x, self.scale4x_model,
-                             tile_size=tile_size, batch_size=batch_size,
-                             enable_amp=enable_amp)
+            return self.scale4x_model
         elif method == "noise":
-            z = tiled_render(x, self.noise_models[noise_level],
-                             tile_size=tile_size, batch_size=batch_size,
-                             enable_amp=enable_amp)
+            return self.noise_models[noise_level]
         elif method == "noise_scale":
-            z = tiled_render(x, self.noise_scale_models[noise_level],
-                             tile_size=tile_size, batch_size=batch_size,
-                             enable_amp=enable_amp)
+            return self.noise_scale_models[noise_level]
         elif method == "noise_scale4x":
-            z = tiled_render(x, self.noise_scale4x_models[noise_level],
-                             tile_size=tile_size, batch_size=batch_size,
-                             enable_amp=enable_amp)
-        return z
+            return self.noise_scale4x_models[noise_level]
 
-    def _model_offset(self, method, noise_level):
+    def _loaded_models(self):
+        models = [self.scale_model, self.scale4x_model,
+                  *self.noise_models, *self.noise_scale_models, *self.noise_scale4x_models]
+        if self.registry is not None:
+            with self.registry.lock:
+                models += [entry.model for entry in self.registry.entries.values()]
+        return [model for model in models if model is not None]
+
+    def share_memory(self):
+        """
+        Move the weights of the loaded models to shared memory.
+        Call it after `load_model()`/`load_model_all()` and before forking or spawning worker processes,
+        then the workers use the weights without copies, and per-worker memory is only activations.
+        CPU only.
+        """
+        assert self.device == "cpu"
+        for model in self._loaded_models():
+            share_model_memory(model)
+
+    @contextmanager
+    def _use_model(self, method, noise_level):
+        """ with self._use_model(method, noise_level) as model: ...
+        model is None when the model file does not exist in lazy loading mode
+        """
+        if self.registry is None:
+            yield self._get_model(method, noise_level)
+            return
+        model_file = self._model_file(method, noise_level)
+        if not path.exists(model_file):
+            yield None
+            return
+        with self.registry.use(model_file, lambda: self._load_model(model_file),
+                               on_evict=self._close_replicas) as model:
+            yield model
+
+    def _get_replicas(self, model):
+        """ returns model replicas for tile sharding, or None for a single device
+        """
+        if model is None:
+            return None
+        with self.replicas_lock:
+            if model not in self.replicas:
+                if self.gpus[0] >= 0 and len(self.gpus) > 1:
+                    self.replicas[model] = DeviceReplicas(model, [f"cuda:{gpu}" for gpu in self.gpus])
+                elif self.gpus[0] < 0 and self.cpu_workers > 1:
+                    self.replicas[model] = ProcessReplicas(model, self.cpu_workers)
+                else:
+                    self.replicas[model] = None
+            return self.replicas[model]
+
+    def _close_replicas(self, model):
+        with self.replicas_lock:
+            replicas = self.replicas.pop(model, None)
+        if replicas is not None:
+            replicas.close()
+
+    def close(self):
+        with self.replicas_lock:
+            replicas_list = list(self.replicas.values())
+            self.replicas = {}
+        for replicas in replicas_list:
+            if replicas is not None:
+                replicas.close()
+
+    def _model_file(self, method, noise_level):
         if method == "scale":
-            return get_model_config(self.scale_model, "i2i_offset")
+            return self._model_path("scale2x")
         elif method == "scale4x":
-            return get_model_config(self.scale4x_model, "i2i_offset")
+            return self._model_path("scale4x")
         elif method == "noise":
-            return get_model_config(self.noise_models[noise_level], "i2i_offset")
+            return self._model_path(f"noise{noise_level}")
         elif method == "noise_scale":
-            return get_model_config(self.noise_scale_models[noise_level], "i2i_offset")
+            return self._model_path(f"noise{noise_level}_scale2x")
         elif method == "noise_scale4x":
-            return get_model_config(self.noise_scale4x_models[noise_level], "i2i_offset")
+            return self._model_path(f"noise{noise_level}_scale4x")
+
+    def _is_cascade_4x(self, method, noise_level):
+        """ True when the 4x model does not exist and 4x is done with the 2x models twice.
+        See `_cascade_4x_methods()`
+        """
+        if method not in {"scale4x", "noise_scale4x"} or path.exists(self._model_file(method, noise_level)):
+            return False
+        first_method, second_method = self._cascade_4x_methods(method)
+        return (path.exists(self._model_file(first_method, noise_level)) and
+                path.exists(self._model_file(second_method, noise_level)))
+
+    @staticmethod
+    def _cascade_4x_methods(method):
+        # noise_scale4x: denoise and 2x, then 2x. scale4x: 2x, then 2x
+        return ("noise_scale" if method == "noise_scale4x" else "scale"), "scale"
+
+    def _render_cascade_4x(self, x, method, noise_level, tile_size=256, batch_size=4, enable_amp=False,
+                           tta=False, tta_level=8, progress=None, roi=None):
+        # The 2x output of the first pass is streamed into the tiles of the second pass,
+        # so the 2x image does not exist in full. See `tiled_render_cascade()`.
+        first_method, second_method = self._cascade_4x_methods(method)
+        with self._use_model(first_method, noise_level) as first_model, \
+             self._use_model(second_method, noise_level) as second_model:
+            z = tiled_render_cascade(x, [first_model, second_model],
+                                     tile_size=tile_size, batch_size=batch_size, enable_amp=enable_amp,
+                                     tta=tta, tta_level=tta_level, progress=progress)
+        if roi is not None:
+            top, left, height, width = roi
+            z = z[:, top * 4:(top + height) * 4, left * 4:(left + width) * 4].contiguous()
+        return z
+
+    def render(self, x, method, noise_level, tile_size=256, batch_size=4, enable_amp=False,
+               skip_uniform=False, render_mask=None, tta=False, tta_level=8, stats=None, progress=None,
+               roi=None, tile_order="row"):
+        """
+        When the 4x model does not exist, 4x is rendered with the 2x models twice.
+        In that case, skip_uniform, render_mask, stats, tile_order and tile sharding are not used,
+        and roi is cropped from the full output.
+        """
+        assert (method in ("scale", "noise_scale", "noise", "scale4x", "noise_scale4x"))
+        assert (method in {"scale", "scale4x"} or 0 <= noise_level and noise_level < 4)
+        if self._is_cascade_4x(method, noise_level):
+            return self._render_cascade_4x(x, method, noise_level, tile_size, batch_size, enable_amp,
+                                           tta=tta, tta_level=tta_level, progress=progress, roi=roi)
+        with self._use_model(method, noise_level) as model:
+            return tiled_render(x, model,
+                                tile_size=tile_size, batch_size=batch_size,
+                                enable_amp=enable_amp, replicas=self._get_replicas(model),
+                                skip_uniform=skip_uniform, render_mask=render_mask,
+                                tta=tta, tta_level=tta_level, stats=stats, progress=progress, roi=roi,
+                                tile_order=tile_order)
+
+    def _model_offset(self, method, noise_level):
+        if self._is_cascade_4x(method, noise_level):
+            # the offset of the second pass is in the 2x output
+            first_method, second_method = self._cascade_4x_methods(method)
+            return (self._model_offset(first_method, noise_level) +
+                    math.ceil(self._model_offset(second_method, noise_level) / 2))
+        with self._use_model(method, noise_level) as model:
+            return get_model_config(model, "i2i_offset")
+
+    def autotune(self, method, noise_level, enable_amp=False, cache_file=DEFAULT_AUTOTUNE_CACHE_FILE):
+        """ returns the best (tile_size, batch_size) for the loaded model on this device
+        """
+        if self._is_cascade_4x(method, noise_level):
+            # both passes are the same architecture. the tile size is tuned with the first one
+            method, _ = self._cascade_4x_methods(method)
+        with self._use_model(method, noise_level) as model:
+            return autotune(model,
+                            model_file=self._model_file(method, noise_level),
+                            enable_amp=enable_amp, cache_file=cache_file)
 
     def convert(self, x, alpha, method, noise_level,
                 tile_size=256, batch_size=4,
-                tta=False, enable_amp=False):
+                tta=False, enable_amp=False, skip_uniform=False, stats=None, fast_alpha=True,
+                tta_level=8, progress=None, roi=None, tile_order="row"):
+        """
+        tta_level: the number of TTA variants (2: hflip, 4: hflip and vflip, 8: full).
+        progress: callback `progress(done, total)` for tiles. It is called for each tiled_render pass
+                  (RGB, then alpha channel). When it returns True, `RenderCancelled` is raised.
+        skip_uniform: skip the model for single-color tiles and fully transparent tiles.
+        stats: dict to receive the number of skipped tiles of the RGB pass.
+        fast_alpha: upscale binary parts of the alpha channel with a cheap edge-aware method,
+                    and use the model only for tiles that have soft alpha values.
+        roi: (top, left, height, width) region of `x` to convert. Only the tiles that overlap the region
+             are rendered, and the output is the same as the crop of the full output.
+        tile_order: traversal order of tiles. row, zorder, hilbert or column.
+        """
         assert (not torch.is_grad_enabled())
         assert (x.shape[0] == 3)
         assert (alpha is None or alpha.shape[0] == 1 and alpha.shape[1:] == x.shape[1:])
@@ -168,28 +431,55 @@ class Waifu2x():
             blank_alpha = torch.equal(alpha, torch.ones(alpha.shape, dtype=alpha.dtype))
         if alpha is not None and not blank_alpha:
             x = self.alpha_pad(x, alpha, self._model_offset(method, noise_level))
-        if tta:
-            rgb = tta_merge([
-                self.render(xx, method, noise_level, tile_size, batch_size, enable_amp)
-                for xx in tta_split(x)])
-        else:
-            rgb = self.render(x, method, noise_level, tile_size, batch_size, enable_amp)
+        render_mask = alpha > 0 if skip_uniform and alpha is not None and not blank_alpha else None
+        rgb = self.render(x, method, noise_level, tile_size, batch_size, enable_amp,
+                          skip_uniform=skip_uniform, render_mask=render_mask,
+                          tta=tta, tta_level=tta_level, stats=stats, progress=progress, roi=roi,
+                          tile_order=tile_order)
+
+        def crop(z, scale_factor):
+            if roi is None:
+                return z
+            top, left, height, width = roi
+            return z[:, top * scale_factor:(top + height) * scale_factor,
+                     left * scale_factor:(left + width) * scale_factor]
 
         rgb = rgb.to("cpu")
         if alpha is not None and method in ("scale", "noise_scale", "scale4x", "noise_scale4x"):
             if not blank_alpha:
-                model = self.scale4x_model if method in {"scale4x", "noise_scale4x"} else self.scale_model
-                if model is not None:
-                    alpha = alpha.expand(3, alpha.shape[1], alpha.shape[2])
-                    alpha = tiled_render(alpha, model,
-                                         tile_size=tile_size, batch_size=batch_size).mean(0, keepdim=True)
-                else:
-                    scale_factor = 4 if method in {"scale4x", "noise_scale4x"} else 2
-                    alpha = F.interpolate(alpha.unsqueeze(0), scale_factor=scale_factor,
-                                          mode="bilinear").squeeze(0)
+                alpha_method = "scale4x" if method in {"scale4x", "noise_scale4x"} else "scale"
+                scale_factor = 4 if method in {"scale4x", "noise_scale4x"} else 2
+                soft_alpha = torch.logical_and(alpha > 0, alpha < 1) if fast_alpha else None
+                cascade = self._is_cascade_4x(alpha_method, -1)
+                with self._use_model(alpha_method, -1) as model:
+                    if (model is not None or cascade) and fast_alpha and not soft_alpha.any():
+                        alpha = crop(upscale_binary_alpha(alpha.unsqueeze(0), scale_factor).squeeze(0),
+                                     scale_factor)
+                    elif cascade:
+                        alpha = alpha.expand(3, alpha.shape[1], alpha.shape[2])
+                        alpha = self._render_cascade_4x(alpha, alpha_method, -1, tile_size, batch_size,
+                                                        progress=progress, roi=roi).mean(0, keepdim=True)
+                    elif model is not None:
+                        alpha = alpha.expand(3, alpha.shape[1], alpha.shape[2])
+                        # `stats` counts only the RGB pass. Tiles without soft alpha are skipped here
+                        # and they are not transparent tiles
+                        alpha = tiled_render(alpha, model,
+                                             tile_size=tile_size, batch_size=batch_size,
+                                             skip_uniform=skip_uniform,
+                                             render_mask=soft_alpha,
+                                             fill_func=lambda x: upscale_binary_alpha(x, scale_factor),
+                                             replicas=self._get_replicas(model),
+                                             progress=progress, roi=roi, tile_order=tile_order
+                                             ).mean(0, keepdim=True)
+                    else:
+                        alpha = crop(F.interpolate(alpha.unsqueeze(0), scale_factor=scale_factor,
+                                                   mode="bilinear").squeeze(0), scale_factor)
             else:
                 scale_factor = 4 if method in {"scale4x", "noise_scale4x"} else 2
-                alpha = F.interpolate(alpha.unsqueeze(0), scale_factor=scale_factor, mode="nearest").squeeze(0)
+                alpha = crop(F.interpolate(alpha.unsqueeze(0), scale_factor=scale_factor, mode="nearest").squeeze(0),
+                             scale_factor)
             alpha = alpha.to("cpu")
+        elif alpha is not None:
+            alpha = crop(alpha, 1)
 
         return rgb, alpha
@@ -26,7 +26,8 @@ from urllib.parse import (
 import uuid
 from nunif.logger import logger, set_log_level
 from nunif.utils.filename import set_image_ext
-from ..utils import Waifu2x
+from nunif.utils.render import RenderCancelled
+from ..utils import Waifu2x, ModelRegistry, DEFAULT_AUTOTUNE_CACHE_FILE, OPTIMIZE_METHODS
 
 
 DEFAULT_ART_MODEL_DIR = path.abspath(path.join(
@@ -98,7 +99,9 @@ def setup():
                         help="web root directory")
     parser.add_argument("--backend", type=str, default="waitress",
                         help="server backend. It may not work except `waitress`.")
-    parser.add_argument("--workers", type=int, default=1, help="The number of worker processes for gunicorn")
+    parser.add_argument("--workers", type=int, default=1,
+                        help=("The number of worker processes for gunicorn. "
+                              "On CPU, the model weights are shared between the workers"))
     parser.add_argument("--threads", type=int, default=32, help="The number of threads")
     parser.add_argument("--debug", action="store_true", help="Debug print")
     parser.add_argument("--max-body-size", type=int, default=5, help="maximum allowed size(MB) for uploaded files")
@@ -110,7 +113,24 @@ def setup():
     parser.add_argument("--gpu", "-g", type=int, nargs="+", default=[0], help="GPU device ids. -1 for CPU")
     parser.add_argument("--tile-size", type=int, default=256, help="tile size for tiled render")
     parser.add_argument("--batch-size", type=int, default=4, help="minibatch size for tiled render")
+    parser.add_argument("--autotune", action="store_true",
+                        help="benchmark and use the best tile size and batch size for each model")
+    parser.add_argument("--autotune-cache", type=str, default=DEFAULT_AUTOTUNE_CACHE_FILE,
+                        help="cache file for --autotune results")
+    parser.add_argument("--optimize", type=str, default="none", choices=OPTIMIZE_METHODS,
+                        help=("optimize the models with TorchScript (script), torch.compile (compile) "
+                              "or channels_last and fused Conv2d+LeakyReLU (fuse). "
+                              "falls back to the eager model when it fails"))
+    parser.add_argument("--preload-models", action="store_true",
+                        help="load all models at startup. otherwise each model is loaded on first use")
+    parser.add_argument("--max-model-memory", type=int, default=0,
+                        help=("memory budget (MB) for the loaded models. "
+                              "the least recently used models are unloaded over the budget. 0 for unlimited"))
     parser.add_argument("--tta", action="store_true", help="use TTA mode")
+    parser.add_argument("--tta-level", type=int, default=8, choices=[2, 4, 8],
+                        help="number of TTA variants. 2: hflip, 4: hflip+vflip, 8: hflip+vflip+transpose")
+    parser.add_argument("--skip-uniform-tiles", action="store_true",
+                        help="skip the model for single-color tiles and fully transparent tiles")
     parser.add_argument("--disable-amp", action="store_true", help="disable AMP for some special reason")
     parser.add_argument("--image-lib", type=str, choices=["pil", "wand"], default="pil",
                         help="image library to encode/decode images")
@@ -121,11 +141,44 @@ def setup():
     parser.add_argument("--config", type=str, help="config file for API tokens")
 
     args = parser.parse_args()
-    art_ctx = Waifu2x(model_dir=args.art_model_dir, gpus=args.gpu)
-    photo_ctx = Waifu2x(model_dir=args.photo_model_dir, gpus=args.gpu)
-
-    art_ctx.load_model_all(load_4x=False)
-    photo_ctx.load_model_all(load_4x=False)
+    # gunicorn workers are forked after setup(). The models are loaded and moved to shared memory here,
+    # so that the workers share the weights instead of loading their own copies.
+    share_models = args.backend == "gunicorn" and args.workers > 1 and args.gpu[0] < 0
+    preload_models = args.preload_models or share_models
+    if preload_models:
+        registry = None
+    else:
+        # art and photo models share the memory budget
+        registry = ModelRegistry(max_bytes=args.max_model_memory * 1048576 if args.max_model_memory > 0 else None)
+    art_ctx = Waifu2x(model_dir=args.art_model_dir, gpus=args.gpu, registry=registry)
+    photo_ctx = Waifu2x(model_dir=args.photo_model_dir, gpus=args.gpu, registry=registry)
+
+    if preload_models:
+        art_ctx.load_model_all(load_4x=False)
+        photo_ctx.load_model_all(load_4x=False)
+    if args.autotune:
+        tile_params = {
+            StyleOption.ART: autotune_all(art_ctx, args),
+            StyleOption.PHOTO: autotune_all(photo_ctx, args),
+        }
+    else:
+        tile_params = None
+    if args.optimize != "none":
+        # models are optimized for --tile-size. autotuned tile sizes may be compiled again on the first request
+        for ctx in (art_ctx, photo_ctx):
+            if preload_models:
+                ctx.load_model_all(load_4x=False, optimize=args.optimize,
+                                   tile_size=args.tile_size, batch_size=args.batch_size,
+                                   enable_amp=not args.disable_amp)
+            else:
+                ctx.set_optimize(args.optimize, tile_size=args.tile_size, batch_size=args.batch_size,
+                                 enable_amp=not args.disable_amp)
+        if registry is not None:
+            # unload the eager models loaded by autotune
+            registry.clear()
+    if share_models:
+        art_ctx.share_memory()
+        photo_ctx.share_memory()
 
     cache = Cache(args.cache_dir, size_limit=args.cache_size_limit * 1073741824)
     cache_gc = CacheGC(cache, args.cache_ttl * 60)
@@ -138,11 +191,28 @@ def setup():
         else:
             config["recaptcha"] = {"site_key": "", "secret_key": ""}
 
-    return args, config, art_ctx, photo_ctx, cache, cache_gc
+    return args, config, art_ctx, photo_ctx, tile_params, cache, cache_gc
+
+
+def autotune_all(ctx, args):
+    # (method, noise_level) -> (tile_size, batch_size)
+    params = {("scale", -1): ctx.autotune("scale", -1, enable_amp=not args.disable_amp,
+                                          cache_file=args.autotune_cache)}
+    for method in ("noise", "noise_scale"):
+        for noise_level in range(4):
+            params[(method, noise_level)] = ctx.autotune(
+                method, noise_level, enable_amp=not args.disable_amp, cache_file=args.autotune_cache)
+    return params
+
+
+def get_tile_params(style, method, noise):
+    if tile_params is None:
+        return command_args.tile_size, command_args.batch_size
+    return tile_params[style][(method, noise.value)]
 
 
 global_lock = threading.RLock()
-command_args, config, art_ctx, photo_ctx, cache, cache_gc = setup()
+command_args, config, art_ctx, photo_ctx, tile_params, cache, cache_gc = setup()
 # HACK: Avoid unintended argparse in the backend(gunicorn).
 sys.argv = [sys.argv[0]]
 
@@ -334,6 +404,19 @@ def api_get_error():
     bottle.abort(405, "Method Not Allowed")
 
 
+def make_cancel_callback(request):
+    # waitress sets `waitress.client_disconnected` when `channel_request_lookahead` > 0.
+    # Rendering for a disconnected client is stopped at the next tile minibatch.
+    client_disconnected = request.environ.get("waitress.client_disconnected")
+    if client_disconnected is None:
+        return None
+
+    def progress(done, total):
+        return client_disconnected()
+
+    return progress
+
+
 @bottle.post("/api")
 def api():
     # {'url': 'https://ja.wikipedia.org/static/images/icons/wikipedia.png',
@@ -368,17 +451,26 @@ def api():
         else:
             with torch.no_grad():
                 rgb, alpha = IL.to_tensor(im, return_alpha=True)
+                tile_size, batch_size = get_tile_params(style, method, noise)
                 ctx_kwargs = {
                     "x": rgb, "alpha": alpha,
                     "method": method, "noise_level": noise.value,
-                    "tile_size": command_args.tile_size, "batch_size": command_args.batch_size,
-                    "tta": command_args.tta, "enable_amp": not command_args.disable_amp,
+                    "tile_size": tile_size, "batch_size": batch_size,
+                    "tta": command_args.tta, "tta_level": command_args.tta_level,
+                    "enable_amp": not command_args.disable_amp,
+                    "skip_uniform": command_args.skip_uniform_tiles,
+                    "progress": make_cancel_callback(request),
                 }
-                with global_lock:
-                    if style == StyleOption.ART:
-                        rgb, alpha = art_ctx.convert(**ctx_kwargs)
-                    else:
-                        rgb, alpha = photo_ctx.convert(**ctx_kwargs)
+                try:
+                    with global_lock:
+                        if style == StyleOption.ART:
+                            rgb, alpha = art_ctx.convert(**ctx_kwargs)
+                        else:
+                            rgb, alpha = photo_ctx.convert(**ctx_kwargs)
+                except RenderCancelled:
+                    im.close()
+                    logger.debug(f"api: cancelled: client disconnected: {style} {scale} {noise} {image_format}")
+                    bottle.abort(499, "Client Closed Request")
                 z = IL.to_image(rgb, alpha)
             logger.debug(f"api: forward: {round(time()-t, 2)}s, {style} {scale} {noise} {image_format}, "
                          f"pid={os.getpid()}-{threading.get_ident()}")
@@ -471,14 +563,27 @@ def main():
             "max_request_body_size": command_args.max_body_size * SIZE_MB,
             "connection_limit": 256,
             "channel_timeout": 120,
+            # required for `waitress.client_disconnected`
+            "channel_request_lookahead": 5,
         }
-    elif command_args.backend == "gnunicon":
+    elif command_args.backend == "gunicorn":
         # NOTE: gunicorn does not work due to `Cannot re-initialize CUDA in forked subprocess`.
         # Maybe gnunicon uses C-level fork() internally.
+        # On CPU, the workers share the model weights moved to shared memory in setup().
+        num_threads = max(torch.get_num_threads() // command_args.workers, 1)
+
+        def post_fork(server, worker):
+            # split the cores between the workers
+            torch.set_num_threads(num_threads)
+
         backend_kwargs = {
             "preload_app": True,
             "workers": command_args.workers,
+            "threads": command_args.threads,
+            "post_fork": post_fork,
         }
+        # Do not let GC of forked workers touch (and copy) the objects created before fork
+        gc.freeze()
 
     bottle.run(host=command_args.bind_addr, port=command_args.port, debug=command_args.debug,
                server=command_args.backend, **backend_kwargs)